@@ -1,155 +1,1241 @@
 import os
+import sys
+import io
+import csv
+import copy
+import html
+import json
+import math
+import re
+import queue
+import atexit
+import random
+import asyncio
 import logging
+import functools
+import contextvars
+import tempfile
 import time
 import threading
+from logging.handlers import QueueHandler, QueueListener
+from sqlalchemy import func, select, union_all, literal, desc
+from sqlalchemy.exc import IntegrityError, DBAPIError, OperationalError, DisconnectionError
+from sqlalchemy.orm import selectinload
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
-from models import Session, Product, DeliverySlot, Order, OrderItem, Cart, init_db
-from datetime import datetime
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import (
+    Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler,
+    filters, ContextTypes, ConversationHandler
+)
+from models import (
+    Session, Product, DeliverySlot, SlotInstance, Order, OrderItem, Cart, StaffMember, AdminBoard, OrderEvent,
+    DailyOrderStats, DailyProductStats, DailySlotStats, ArchivedOrder, ArchivedOrderItem,
+    DEFAULT_LOW_STOCK_THRESHOLD, init_db, record_order_stats, book_slot, release_slot, claim_order, add_order_event, archive_orders,
+    ReadSession, mark_written, change_stock, apply_stock_threshold,
+    ProductVersion, ensure_product_version, line_price_fields, OutOfStock, set_order_status
+)
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ========== ЛОГИРОВАНИЕ ==========
+
+# Доля сохраняемых INFO-записей горячего пути (запросы к API Telegram, время обработки обновлений)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.1"))
+# Логгеры, все INFO-записи которых сэмплируются
+SAMPLED_LOGGERS = {"httpx"}
+# Контекст обрабатываемого обновления: update_id, user_id, handler
+log_context = contextvars.ContextVar('log_context', default=None)
+
+class ContextFilter(logging.Filter):
+    """Отбрасывает часть INFO-записей горячего пути и дописывает к остальным контекст обновления"""
+
+    def filter(self, record):
+        if record.levelno <= logging.INFO and (getattr(record, 'sampled', False) or record.name in SAMPLED_LOGGERS):
+            if random.random() >= LOG_SAMPLE_RATE:
+                return False
+        context = log_context.get()
+        if context:
+            for key, value in context.items():
+                setattr(record, key, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms')
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    """Кладет в очередь копию записи с args и exc_info: сообщение и трейсбек форматирует JsonFormatter в потоке слушателя"""
+
+    def prepare(self, record):
+        return copy.copy(record)
+
+def setup_logging():
+    """JSON-логи через очередь: обработчик только кладет запись в очередь, запись в поток идет в отдельном потоке"""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+def with_log_context(callback):
+    """Оборачивает колбэк: записи лога внутри получают update_id, user_id и имя обработчика"""
+    @functools.wraps(callback)
+    async def wrapped(update, context):
+        user = getattr(update, 'effective_user', None)
+        token = log_context.set({
+            'update_id': getattr(update, 'update_id', None),
+            'user_id': user.id if user else None,
+            'handler': callback.__name__
+        })
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            duration_ms = round((time.perf_counter() - started) * 1000, 1)
+            logger.info("Обновление обработано за %s мс", duration_ms, extra={'sampled': True, 'duration_ms': duration_ms})
+            log_context.reset(token)
+    wrapped.log_context_bound = True
+    return wrapped
+
+def bind_log_context(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            bind_log_context(handler.entry_points + handler.fallbacks + [h for state in handler.states.values() for h in state])
+        elif isinstance(handler, CallbackRouter):
+            handler.routes = {
+                op: callback if getattr(callback, 'log_context_bound', False) else with_log_context(callback)
+                for op, callback in handler.routes.items()
+            }
+        elif not getattr(handler.callback, 'log_context_bound', False):
+            handler.callback = with_log_context(handler.callback)
+
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "0"))
 
+def parse_id_list(value):
+    return {int(part) for part in value.replace(" ", "").split(",") if part}
+
+# Администраторы и курьеры из окружения; дополнительные сотрудники хранятся в таблице staff
+ROLE_ADMIN = 'admin'
+ROLE_COURIER = 'courier'
+ENV_ADMIN_IDS = parse_id_list(os.environ.get("ADMIN_IDS", "")) | ({ADMIN_ID} if ADMIN_ID else set())
+ENV_COURIER_IDS = parse_id_list(os.environ.get("COURIER_IDS", ""))
+
+# Кэш прав доступа: {user_id: role}
+PERMISSION_CACHE_TTL = 60
+permission_cache = {'loaded_at': 0, 'roles': {}, 'refreshing': False}
+permission_lock = threading.Lock()
+
+# Не более NOTIFY_RATE исходящих уведомлений в секунду (лимит Telegram — около 30)
+NOTIFY_RATE = int(os.environ.get("NOTIFY_RATE", "25"))
+
+# Фоновые задачи бота (диспетчер outbox, разовые отправки и т.п.)
+background_tasks = set()
+# Бесконечные фоновые циклы (диспетчер уведомлений, запись корзин, снятие резервов)
+service_tasks = set()
+# Сколько секунд при остановке ждем начатые отправки и разбор очереди уведомлений
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "20"))
+
+# Сообщения о новом заказе, разосланные диспетчерам: {order_id: [(chat_id, message_id)]}
+order_notifications = {}
+
+# Диспетчер outbox: размер пачки, интервал опроса таблицы и число попыток доставки
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "2"))
+OUTBOX_MAX_ATTEMPTS = 5
+# Пауза перед повтором растет вместе с возрастом события, но не больше OUTBOX_MAX_BACKOFF секунд
+OUTBOX_MAX_BACKOFF = 600
+# На столько секунд забранные диспетчером события скрыты от других реплик; после сбоя отправка повторится
+OUTBOX_CLAIM_TIMEOUT = 300
+outbox_state = {'wakeup': None}
+
+# Живая доска заказов обновляется не чаще раза в BOARD_REFRESH_INTERVAL секунд
+BOARD_REFRESH_INTERVAL = float(os.environ.get("BOARD_REFRESH_INTERVAL", "5"))
+board_state = {'dirty': False, 'task': None, 'last_refresh': 0.0, 'boards': None, 'sent': {}}
+
 # Константы для ConversationHandler
 ADD_NAME, ADD_CATEGORY, ADD_QUANTITY, ADD_PRICE, ADD_PHOTO = range(5)
 EDIT_SELECT, EDIT_ACTION, EDIT_QUANTITY, EDIT_PRICE = range(5, 9)
 ORDER_ADDRESS, ORDER_PHONE, ORDER_SLOT = range(9, 12)
 ADMIN_CANCEL_REASON = 12
+ADMIN_DELIVERY_WEIGHTS = 13
+
+# Максимальная длина текста сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# Размер пачки строк при потоковой выгрузке заказов
+EXPORT_BATCH_SIZE = 1000
+# Глубина экрана статистики в днях
+STATS_DAYS = 7
+
+# История заказов пользователя: заказов на странице и кэш карточек завершенных заказов
+MY_ORDERS_PAGE_SIZE = 5
+MY_ORDERS_CACHE_USERS = 1000
+FINAL_ORDER_STATUSES = ('delivered', 'cancelled')
+
+# Завершенные заказы старше ORDER_ARCHIVE_DAYS дней переносятся в архив (0 — не архивировать)
+ORDER_ARCHIVE_DAYS = int(os.environ.get("ORDER_ARCHIVE_DAYS", "90"))
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_BATCH_SIZE = 500
+my_orders_cache = OrderedDict()  # {user_id: {order_id: текст карточки}}, давно не заходившие вытесняются
+my_orders_cache_lock = threading.Lock()
+
+# Кэш витрины: доступные товары, перечитываются не чаще раза в CATALOG_CACHE_TTL секунд
+CATALOG_CACHE_TTL = 60
+catalog_cache = {'products': None, 'loaded_at': 0}
+catalog_cache_lock = threading.Lock()
+
+# Сколько секунд товар держится в резерве без действий пользователя с корзиной
+RESERVATION_TTL = int(os.environ.get("RESERVATION_TTL", "300"))
+# Шаг колеса таймеров резервов, секунд
+RESERVATION_TICK = 1
 
 # Кэш для блокировки товаров
 product_lock_cache = {}
 lock_cache_expiry = {}
+# Сумма резервов по товару, чтобы не перебирать все блокировки
+reserved_totals = {}
 cache_lock = threading.Lock()
 
+# Сколько дней вперед принимаются заказы (0 — только сегодня)
+DELIVERY_DAYS_AHEAD = int(os.environ.get("DELIVERY_DAYS_AHEAD", "3"))
+
+# Индекс свободных мест на ближайшие дни: {date: {slot_id: {'label', 'start_hour', 'capacity', 'booked'}}}
+SLOT_CACHE_TTL = 30
+slot_availability = {'loaded_at': 0, 'days': {}}
+slot_cache_lock = threading.Lock()
+
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+class AsyncRateLimiter:
+    """Равномерно распределяет вызовы: не более rate за period секунд"""
+
+    def __init__(self, rate, period=1.0):
+        self.interval = period / rate
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_at = max(self._next_at, loop.time()) + self.interval
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+notify_limiter = AsyncRateLimiter(NOTIFY_RATE)
+
+# ========== CALLBACK DATA ==========
+
+# callback_data кнопок: «оп» или «оп:арг1:арг2...», аргументы — целые числа в base36.
+# Разбирается один раз в CallbackRouter, обработчик получает аргументы в context.args.
+CB_PRICES = "p"
+CB_CATALOG = "c"
+CB_CATEGORY = "k"  # индекс в CATEGORIES
+CB_PRODUCT = "pr"  # id товара
+CB_QTY = "q"  # выбранное количество
+CB_ADD_TO_CART = "a"
+CB_CLEAR_CART = "cc"
+CB_CHECKOUT = "co"
+CB_MY_ORDERS = "mo"  # [id заказа, с которого листать]
+CB_REPEAT_ORDER = "ro"  # id заказа
+CB_BACK_MAIN = "bm"
+CB_DAY = "d"  # день (date.toordinal())
+CB_DAY_LIST = "dl"
+CB_SLOT = "s"  # id слота, день
+CB_ADMIN_PANEL = "ap"
+CB_BACK_ADMIN = "ba"
+CB_ADMIN_ADD = "aa"
+CB_ADMIN_EDIT = "ae"
+CB_ADMIN_ORDERS = "ao"
+CB_ADMIN_SLOTS = "as"
+CB_ADMIN_STATS = "st"
+CB_ADMIN_EXPORT = "ex"
+CB_DRAFT = "dr"  # id товара
+CB_NEW_PRODUCT = "np"
+CB_NEW_CATEGORY = "nc"  # индекс в CATEGORIES
+CB_ACCEPT = "oa"  # id заказа
+CB_ON_THE_WAY = "ow"  # id заказа
+CB_DELIVERED = "od"  # id заказа
+CB_CANCEL = "ox"  # id заказа
+CB_CANCELLED_LIST = "lc"
+CB_DELIVERED_LIST = "ld"
+CB_TOGGLE_SLOT = "ts"  # id слота
+
+CATEGORIES = ["Овощи", "Фрукты", "Ягоды"]
+
+# Кнопки старого формата в уже отправленных сообщениях
+LEGACY_CALLBACKS = {
+    "prices": CB_PRICES, "order": CB_CATALOG, "my_order": CB_MY_ORDERS, "back_main": CB_BACK_MAIN,
+    "admin_panel": CB_ADMIN_PANEL, "back_admin": CB_BACK_ADMIN, "admin_orders": CB_ADMIN_ORDERS
+}
+LEGACY_ORDER_CALLBACK = re.compile(r"^admin_(accept|on_the_way|delivered|cancel)_(\d+)$")
+LEGACY_ORDER_OPS = {"accept": CB_ACCEPT, "on_the_way": CB_ON_THE_WAY, "delivered": CB_DELIVERED, "cancel": CB_CANCEL}
+
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def to_base36(value):
+    if value < 0:
+        return "-" + to_base36(-value)
+    digits = ""
+    while True:
+        value, remainder = divmod(value, 36)
+        digits = BASE36_DIGITS[remainder] + digits
+        if not value:
+            return digits
+
+def encode_callback(op, *args):
+    return ":".join([op] + [to_base36(arg) for arg in args])
+
+@functools.lru_cache(maxsize=4096)
+def decode_callback(data):
+    """Возвращает (op, args) или None для чужих и поврежденных данных"""
+    if data in LEGACY_CALLBACKS:
+        return LEGACY_CALLBACKS[data], ()
+    match = LEGACY_ORDER_CALLBACK.match(data)
+    if match:
+        return LEGACY_ORDER_OPS[match.group(1)], (int(match.group(2)),)
+
+    op, *parts = data.split(":")
+    try:
+        return op, tuple(int(part, 36) for part in parts)
+    except ValueError:
+        return None
+
+class CallbackRouter(CallbackQueryHandler):
+    """Один обработчик на набор колбэков: опкод ищется в словаре routes вместо перебора шаблонов"""
+
+    def __init__(self, routes):
+        # Общий колбэк не нужен: handle_update вызывает обработчик из routes напрямую
+        super().__init__(callback=None)
+        self.routes = routes
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or not update.callback_query or not update.callback_query.data:
+            return None
+        decoded = decode_callback(update.callback_query.data)
+        if decoded and decoded[0] in self.routes:
+            return decoded
+        return None
+
+    async def handle_update(self, update, application, check_result, context):
+        op, args = check_result
+        context.args = list(args)
+        return await self.routes[op](update, context)
+
+# ========== ЗАЩИТА ОТ ФЛУДА ==========
+
+# Сколько обновлений в секунду в среднем допускается от одного пользователя и допустимый всплеск
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", "2"))
+FLOOD_BURST = int(os.environ.get("FLOOD_BURST", "8"))
+
+class TokenBucketLimiter:
+    """Корзины токенов по пользователям: каждое обновление тратит токен, токены копятся со скоростью rate"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # {user_id: (токены, время последнего пополнения)}
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+
+        # Полные корзины неотличимы от отсутствующих — периодически их выбрасываем
+        if len(self.buckets) > 10000:
+            refill_time = self.burst / self.rate
+            self.buckets = {uid: state for uid, state in self.buckets.items() if now - state[1] < refill_time}
+        return allowed
+
+flood_limiter = TokenBucketLimiter(FLOOD_RATE, FLOOD_BURST)
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Срабатывает раньше всех обработчиков: лишние обновления пользователя отбрасываются сразу"""
+    user = update.effective_user
+    if not user or is_staff(user.id) or flood_limiter.allow(user.id):
+        return
+
+    if update.callback_query:
+        try:
+            await update.callback_query.answer("⏳ Слишком часто. Подождите секунду.")
+        except BadRequest:
+            pass
+    raise ApplicationHandlerStop
+
+# ========== ДОСТУП К БД ==========
+
+# Сколько раз повторять обращение к БД при обрыве соединения или взаимной блокировке
+DB_RETRIES = 2
+# После стольких неудач подряд обращения к БД приостанавливаются на DB_BREAKER_RESET секунд
+DB_BREAKER_THRESHOLD = int(os.environ.get("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_RESET = float(os.environ.get("DB_BREAKER_RESET", "30"))
+# Экраны, которые при недоступной БД показываются из кэша
+BREAKER_SAFE_CALLBACKS = {CB_PRICES, CB_CATALOG, CB_CATEGORY}
+
+class DatabaseUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    """Размыкается после threshold неудач подряд; через reset_timeout снова пропускает запросы,
+    и первая же неудача размыкает его опять"""
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error("БД недоступна, обращения приостановлены на %s с", self.reset_timeout)
+                self.opened_at = time.monotonic()
+
+db_breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_RESET)
+db_counters = {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0, 'stale_catalog': 0}
+db_counters_lock = threading.Lock()
+
+def count_db(name):
+    with db_counters_lock:
+        db_counters[name] += 1
+
+def is_transient_db_error(error):
+    return isinstance(error, (OperationalError, DisconnectionError)) or (isinstance(error, DBAPIError) and error.connection_invalidated)
+
+def run_db(fn, *args, **kwargs):
+    """Выполняет fn (открывающую свою сессию) с повтором при временных ошибках БД.
+
+    Пока предохранитель разомкнут, сразу бросает DatabaseUnavailable.
+    """
+    if db_breaker.is_open():
+        count_db('rejected')
+        raise DatabaseUnavailable()
+
+    count_db('calls')
+    for attempt in range(DB_RETRIES + 1):
+        try:
+            result = fn(*args, **kwargs)
+        except DBAPIError as e:
+            if not is_transient_db_error(e):
+                raise
+            if attempt == DB_RETRIES:
+                count_db('failures')
+                db_breaker.record_failure()
+                raise DatabaseUnavailable() from e
+            count_db('retries')
+            time.sleep(0.05 * 2 ** attempt)
+        else:
+            db_breaker.record_success()
+            return result
+
+async def reply_db_unavailable(update: Update):
+    text = "⏳ Сервис временно недоступен. Попробуйте через минуту."
+    if update.callback_query:
+        try:
+            await update.callback_query.answer(text, show_alert=True)
+            return
+        except BadRequest:
+            pass
+    if update.effective_message:
+        await update.effective_message.reply_text(text)
+
+async def db_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пока БД недоступна, отвечает сразу, не доходя до обработчиков; витрина отдается из кэша"""
+    if not db_breaker.is_open():
+        return
+    query = update.callback_query
+    decoded = decode_callback(query.data) if query and query.data else None
+    if decoded and decoded[0] in BREAKER_SAFE_CALLBACKS and catalog_cache['products'] is not None:
+        return
+    count_db('rejected')
+    await reply_db_unavailable(update)
+    raise ApplicationHandlerStop
+
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    error = context.error
+    if isinstance(error, DBAPIError):
+        # Ошибка из обращения мимо run_db тоже учитывается предохранителем
+        if is_transient_db_error(error):
+            count_db('failures')
+            db_breaker.record_failure()
+        logger.error("Ошибка БД при обработке обновления: %s", error)
+    elif isinstance(error, DatabaseUnavailable):
+        logger.warning("Обновление не обработано: БД недоступна")
+    else:
+        logger.error("Необработанная ошибка", exc_info=error)
+        return
+
+    if isinstance(update, Update):
+        try:
+            await reply_db_unavailable(update)
+        except Exception as e:
+            logger.error("Не удалось ответить пользователю: %s", e)
+
+async def admin_health_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/health — состояние доступа к БД и счетчики"""
+    if not is_admin(update.effective_user.id):
+        return
+
+    with db_counters_lock:
+        counters = dict(db_counters)
+    state = "🔴 разомкнут" if db_breaker.is_open() else "🟢 замкнут"
+    await update.message.reply_text(
+        f"🩺 Предохранитель БД: {state}\n"
+        f"Обращений: {counters['calls']}\n"
+        f"Повторов: {counters['retries']}\n"
+        f"Неудач: {counters['failures']}\n"
+        f"Отклонено при недоступной БД: {counters['rejected']}\n"
+        f"Витрина из устаревшего кэша: {counters['stale_catalog']}"
+    )
+
+# ========== КОРЗИНЫ ==========
+
+# Корзины живут в памяти процесса и сбрасываются в таблицу carts раз в CART_FLUSH_INTERVAL секунд
+CART_FLUSH_INTERVAL = float(os.environ.get("CART_FLUSH_INTERVAL", "30"))
+# Не менявшиеся корзины выгружаются из памяти через CART_IDLE_TTL секунд
+CART_IDLE_TTL = 3600
+
+class CartLine:
+    __slots__ = ('product_id', 'version_id', 'product_name', 'quantity', 'price_per_kg')
+
+    def __init__(self, product_id, version_id, product_name, quantity, price_per_kg):
+        self.product_id = product_id
+        self.version_id = version_id
+        self.product_name = product_name
+        self.quantity = quantity
+        self.price_per_kg = price_per_kg
+
+class InMemoryCartStore:
+    """Хранилище корзин в памяти процесса с отложенной записью в таблицу carts.
+
+    Нажатия в каталоге меняют только память; в БД попадают лишь измененные
+    корзины — пачкой при flush(). Общее хранилище для нескольких реплик
+    подключается заменой cart_store объектом с тем же интерфейсом.
+    """
+
+    def __init__(self):
+        self._carts = {}  # {user_id: {product_id: CartLine}}
+        self._touched = {}  # {user_id: время последнего обращения}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _load(self, user_id):
+        with self._lock:
+            if user_id in self._carts:
+                self._touched[user_id] = time.time()
+                return self._carts[user_id]
+
+        session = Session()
+        rows = session.query(Cart).filter(Cart.user_id == user_id).all()
+        session.close()
+
+        with self._lock:
+            # Корзину мог загрузить параллельный обработчик — его версия актуальнее
+            cart = self._carts.setdefault(user_id, {
+                row.product_id: CartLine(row.product_id, row.version_id, row.product_name, row.quantity, row.price_per_kg)
+                for row in rows
+            })
+            self._touched[user_id] = time.time()
+            return cart
+
+    def get(self, user_id):
+        cart = self._load(user_id)
+        with self._lock:
+            return [
+                CartLine(line.product_id, line.version_id, line.product_name, line.quantity, line.price_per_kg)
+                for line in cart.values()
+            ]
+
+    def add(self, user_id, product, quantity):
+        self.add_many(user_id, [(product, quantity)])
+
+    def add_many(self, user_id, items):
+        """Добавляет пары (товар, количество) за одну блокировку"""
+        cart = self._load(user_id)
+        with self._lock:
+            for product, quantity in items:
+                line = cart.get(product.id)
+                if line:
+                    line.quantity += quantity
+                else:
+                    cart[product.id] = CartLine(product.id, product.version_id, product.name, quantity, product.price_per_kg)
+            self._dirty.add(user_id)
+
+    def remove(self, user_id, product_id):
+        cart = self._load(user_id)
+        with self._lock:
+            if cart.pop(product_id, None):
+                self._dirty.add(user_id)
+
+    def clear(self, user_id, persisted=False):
+        """Очищает корзину; persisted=True — строки в carts уже удалены вызывающим"""
+        with self._lock:
+            self._carts[user_id] = {}
+            self._touched[user_id] = time.time()
+            if persisted:
+                self._dirty.discard(user_id)
+            else:
+                self._dirty.add(user_id)
+
+    def flush(self, user_ids=None):
+        """Записывает измененные корзины в БД одной транзакцией; возвращает их число"""
+        with self._lock:
+            users = set(self._dirty) if user_ids is None else self._dirty & set(user_ids)
+            self._dirty -= users
+            snapshot = {
+                user_id: [
+                    (line.product_id, line.version_id, line.product_name, line.quantity, line.price_per_kg)
+                    for line in self._carts.get(user_id, {}).values()
+                ]
+                for user_id in users
+            }
+
+            # Выгружаем давно не использованные корзины, уже записанные в БД
+            expired_before = time.time() - CART_IDLE_TTL
+            for user_id in [u for u, touched in self._touched.items() if touched < expired_before and u not in self._dirty and u not in users]:
+                self._carts.pop(user_id, None)
+                self._touched.pop(user_id, None)
+
+        if not snapshot:
+            return 0
+
+        session = Session()
+        try:
+            session.query(Cart).filter(Cart.user_id.in_(list(snapshot))).delete(synchronize_session=False)
+            session.add_all([
+                Cart(
+                    user_id=user_id, product_id=product_id, quantity=quantity,
+                    **line_price_fields(version_id, product_name, price_per_kg)
+                )
+                for user_id, lines in snapshot.items()
+                for product_id, version_id, product_name, quantity, price_per_kg in lines
+            ])
+            session.commit()
+        except Exception:
+            session.rollback()
+            with self._lock:
+                self._dirty |= set(snapshot)
+            raise
+        finally:
+            session.close()
+        return len(snapshot)
+
+cart_store = InMemoryCartStore()
+
+async def run_order_archiver():
+    """Раз в ARCHIVE_INTERVAL переносит давние завершенные заказы в архив пачками по ARCHIVE_BATCH_SIZE"""
+    while True:
+        try:
+            before = datetime.now() - timedelta(days=ORDER_ARCHIVE_DAYS)
+            total = 0
+            while True:
+                moved = await asyncio.to_thread(archive_orders_batch, before)
+                total += moved
+                if moved < ARCHIVE_BATCH_SIZE:
+                    break
+                # Пауза между пачками, чтобы не занимать БД надолго
+                await asyncio.sleep(0.5)
+            if total:
+                logger.info("В архив перенесено заказов: %s", total)
+        except Exception as e:
+            logger.error("Ошибка при архивации заказов: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+def archive_orders_batch(before):
+    session = Session()
+    try:
+        moved = archive_orders(session, before, ARCHIVE_BATCH_SIZE)
+        session.commit()
+        return moved
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+async def run_cart_flusher():
+    """Фоновая запись измененных корзин в БД"""
+    while True:
+        await asyncio.sleep(CART_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(cart_store.flush)
+        except Exception as e:
+            logger.error("Ошибка при сохранении корзин: %s", e)
+
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 
 def get_main_keyboard(user_id: int):
     keyboard = [
-        [InlineKeyboardButton("💰 Цены", callback_data="prices")],
-        [InlineKeyboardButton("🛒 ЗАКАЗАТЬ 🛒", callback_data="order")],
-        [InlineKeyboardButton("📦 Мои заказы", callback_data="my_order")]
+        [InlineKeyboardButton("💰 Цены", callback_data=CB_PRICES)],
+        [InlineKeyboardButton("🛒 ЗАКАЗАТЬ 🛒", callback_data=CB_CATALOG)],
+        [InlineKeyboardButton("📦 Мои заказы", callback_data=CB_MY_ORDERS)]
     ]
     return InlineKeyboardMarkup(keyboard)
 
 def get_admin_keyboard():
     keyboard = [
-        [InlineKeyboardButton("Внести товар", callback_data="admin_add")],
-        [InlineKeyboardButton("Редактировать товары", callback_data="admin_edit")],
-        [InlineKeyboardButton("Заказы", callback_data="admin_orders")],
-        [InlineKeyboardButton("Слоты доставки", callback_data="admin_slots")]
+        [InlineKeyboardButton("Внести товар", callback_data=CB_ADMIN_ADD)],
+        [InlineKeyboardButton("Редактировать товары", callback_data=CB_ADMIN_EDIT)],
+        [InlineKeyboardButton("Заказы", callback_data=CB_ADMIN_ORDERS)],
+        [InlineKeyboardButton("Слоты доставки", callback_data=CB_ADMIN_SLOTS)],
+        [InlineKeyboardButton("📊 Статистика", callback_data=CB_ADMIN_STATS)],
+        [InlineKeyboardButton("📤 Выгрузка за месяц", callback_data=CB_ADMIN_EXPORT)]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def load_staff():
+    session = Session()
+    try:
+        return session.query(StaffMember.user_id, StaffMember.role).all()
+    finally:
+        session.close()
+
+def load_permissions():
+    """Собирает карту ролей из окружения и таблицы staff (окружение имеет приоритет)"""
+    staff = run_db(load_staff)
+
+    roles = {user_id: role for user_id, role in staff}
+    roles.update({user_id: ROLE_COURIER for user_id in ENV_COURIER_IDS})
+    roles.update({user_id: ROLE_ADMIN for user_id in ENV_ADMIN_IDS})
+
+    with permission_lock:
+        permission_cache['roles'] = roles
+        permission_cache['loaded_at'] = time.time()
+    return roles
+
+def refresh_permissions():
+    """Перечитывает карту ролей; при недоступной БД остается прежняя"""
+    try:
+        load_permissions()
+    except Exception as e:
+        logger.error("Не удалось обновить карту ролей: %s", e)
+    finally:
+        with permission_lock:
+            permission_cache['refreshing'] = False
+
+def get_roles():
+    """Карта ролей из кэша; устаревшая перечитывается в фоновом потоке, так что вызов никогда не ждет БД"""
+    with permission_lock:
+        roles = permission_cache['roles']
+        refresh = (
+            time.time() - permission_cache['loaded_at'] >= PERMISSION_CACHE_TTL
+            and not permission_cache['refreshing']
+        )
+        if refresh:
+            permission_cache['refreshing'] = True
+    if refresh:
+        threading.Thread(target=refresh_permissions, name='permissions-refresh', daemon=True).start()
+    if roles:
+        return roles
+    # До первой загрузки работаем по окружению
+    roles = {user_id: ROLE_COURIER for user_id in ENV_COURIER_IDS}
+    roles.update({user_id: ROLE_ADMIN for user_id in ENV_ADMIN_IDS})
+    return roles
+
+def get_role(user_id):
+    return get_roles().get(user_id)
+
+def is_admin(user_id):
+    return get_role(user_id) == ROLE_ADMIN
+
+def is_staff(user_id):
+    return get_role(user_id) in (ROLE_ADMIN, ROLE_COURIER)
+
+def get_staff_ids():
+    return [user_id for user_id, role in get_roles().items() if role in (ROLE_ADMIN, ROLE_COURIER)]
+
+def get_courier_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("Заказы", callback_data=CB_ADMIN_ORDERS)]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def lock_product(product_id, user_id, quantity):
+def get_panel_keyboard(user_id):
+    """Клавиатура панели по роли: полная для администратора, только заказы для курьера"""
+    return get_admin_keyboard() if is_admin(user_id) else get_courier_keyboard()
+
+async def send_limited(bot, chat_id, **kwargs):
+    async with notify_limiter:
+        return await bot.send_message(chat_id=chat_id, **kwargs)
+
+async def broadcast(bot, chat_ids, **kwargs):
+    """Параллельно рассылает сообщение через общий ограничитель частоты.
+
+    Возвращает список (chat_id, message) для успешно доставленных сообщений.
+    """
+    results = await asyncio.gather(
+        *(send_limited(bot, chat_id, **kwargs) for chat_id in chat_ids),
+        return_exceptions=True
+    )
+    sent = []
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка при отправке сообщения %s: %s", chat_id, result)
+        else:
+            sent.append((chat_id, result))
+    return sent
+
+class TimerWheel:
+    """Хешированное колесо таймеров: постановка и снятие за O(1), за тик разбирается одна ячейка.
+
+    Не потокобезопасно — вызывается под cache_lock.
+    """
+
+    def __init__(self, tick, horizon):
+        self.tick = tick
+        self.slots = [{} for _ in range(int(horizon // tick) + 2)]
+        self.slot_of = {}
+        self.cursor = int(time.time() // tick)
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        index = int(deadline // self.tick) % len(self.slots)
+        self.slots[index][key] = deadline
+        self.slot_of[key] = index
+
+    def cancel(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            self.slots[index].pop(key, None)
+
+    def advance(self, now):
+        """Возвращает ключи, срок которых истек в уже завершившихся тиках"""
+        due = []
+        current = int(now // self.tick)
+        self.cursor = max(self.cursor, current - len(self.slots))
+        while self.cursor < current:
+            slot = self.slots[self.cursor % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                # Сроки дальше одного оборота колеса ждут следующего прохода
+                if deadline <= now:
+                    del slot[key]
+                    del self.slot_of[key]
+                    due.append(key)
+            self.cursor += 1
+        return due
+
+reservation_wheel = TimerWheel(RESERVATION_TICK, RESERVATION_TTL)
+
+def drop_lock(key):
+    """Снимает резерв по ключу; вызывается под cache_lock"""
+    lock_info = product_lock_cache.pop(key, None)
+    lock_cache_expiry.pop(key, None)
+    reservation_wheel.cancel(key)
+    if lock_info:
+        remaining = reserved_totals.get(lock_info['product_id'], 0) - lock_info['quantity']
+        if remaining > 0:
+            reserved_totals[lock_info['product_id']] = remaining
+        else:
+            reserved_totals.pop(lock_info['product_id'], None)
+    return lock_info
+
+def add_reservation(product_id, user_id, quantity, current_time):
+    """Увеличивает резерв пользователя и продлевает его; вызывается под cache_lock"""
+    key = f"{product_id}_{user_id}"
+    lock_info = product_lock_cache.setdefault(key, {
+        'product_id': product_id,
+        'user_id': user_id,
+        'quantity': 0,
+        'locked_at': current_time
+    })
+    lock_info['quantity'] += quantity
+    reserved_totals[product_id] = reserved_totals.get(product_id, 0) + quantity
+    lock_cache_expiry[key] = current_time + RESERVATION_TTL
+    reservation_wheel.schedule(key, current_time + RESERVATION_TTL)
+
+def lock_product(product_id, user_id, quantity, stock):
+    """Резервирует еще quantity шт., если stock минус все резервы это позволяет.
+
+    Проверка и запись идут под одной блокировкой, поэтому параллельные
+    покупатели делят остаток, но вместе не превышают его.
+    """
     current_time = time.time()
-    expiry_time = current_time + 300
 
     with cache_lock:
-        expired_keys = [key for key, expiry in lock_cache_expiry.items() if expiry < current_time]
-        for key in expired_keys:
-            if key in product_lock_cache:
-                del product_lock_cache[key]
-            if key in lock_cache_expiry:
-                del lock_cache_expiry[key]
-
-        key = f"{product_id}_{user_id}"
-        for cache_key in list(product_lock_cache.keys()):
-            if cache_key.startswith(f"{product_id}_") and cache_key != key:
-                return False
+        if stock - reserved_totals.get(product_id, 0) < quantity:
+            return False
 
-        product_lock_cache[key] = {
-            'product_id': product_id,
-            'user_id': user_id,
-            'quantity': quantity,
-            'locked_at': current_time
-        }
-        lock_cache_expiry[key] = expiry_time
+        add_reservation(product_id, user_id, quantity, current_time)
 
     return True
 
+def lock_products(user_id, requests):
+    """Резервирует несколько товаров за одну блокировку.
+
+    requests — {product_id: (нужно, остаток)}; каждому товару достается
+    сколько есть из незарезервированного остатка. Возвращает {product_id: зарезервировано}.
+    """
+    current_time = time.time()
+    granted = {}
+
+    with cache_lock:
+        for product_id, (quantity, stock) in requests.items():
+            quantity = min(quantity, stock - reserved_totals.get(product_id, 0))
+            if quantity <= 0:
+                continue
+
+            add_reservation(product_id, user_id, quantity, current_time)
+            granted[product_id] = quantity
+
+    return granted
+
 def unlock_product(product_id, user_id):
     key = f"{product_id}_{user_id}"
     with cache_lock:
-        if key in product_lock_cache:
-            del product_lock_cache[key]
-        if key in lock_cache_expiry:
-            del lock_cache_expiry[key]
+        drop_lock(key)
 
-def get_locked_quantity(product_id):
+def unlock_user_products(user_id):
     with cache_lock:
-        total_locked = 0
-        current_time = time.time()
-
-        expired_keys = [key for key, expiry in lock_cache_expiry.items() if expiry < current_time]
-        for key in expired_keys:
-            if key in product_lock_cache:
-                del product_lock_cache[key]
-            if key in lock_cache_expiry:
-                del lock_cache_expiry[key]
+        for key in [key for key, lock_info in product_lock_cache.items() if lock_info['user_id'] == user_id]:
+            drop_lock(key)
 
+def touch_reservations(user_id):
+    """Продлевает резервы пользователя на RESERVATION_TTL при любом действии с корзиной"""
+    expiry_time = time.time() + RESERVATION_TTL
+    with cache_lock:
         for key, lock_info in product_lock_cache.items():
-            if key.startswith(f"{product_id}_"):
-                total_locked += lock_info['quantity']
+            if lock_info['user_id'] == user_id:
+                lock_cache_expiry[key] = expiry_time
+                reservation_wheel.schedule(key, expiry_time)
+
+def release_all_reservations():
+    """Снимает все резервы (при остановке бота); возвращает их количество"""
+    with cache_lock:
+        count = len(product_lock_cache)
+        for key in list(product_lock_cache):
+            drop_lock(key)
+        return count
 
+def expire_reservations():
+    """Снимает истекшие резервы; возвращает список (user_id, product_id)"""
+    with cache_lock:
+        expired = []
+        for key in reservation_wheel.advance(time.time()):
+            lock_info = drop_lock(key)
+            if lock_info:
+                expired.append((lock_info['user_id'], lock_info['product_id']))
+        return expired
+
+def get_locked_quantity(product_id, exclude_user_id=None):
+    """Сколько штук товара зарезервировано, без учета резерва exclude_user_id"""
+    with cache_lock:
+        total_locked = reserved_totals.get(product_id, 0)
+        if exclude_user_id is not None:
+            own = product_lock_cache.get(f"{product_id}_{exclude_user_id}")
+            if own:
+                total_locked -= own['quantity']
         return total_locked
 
-def get_available_quantity(product_id):
-    session = Session()
-    product = session.query(Product).filter(Product.id == product_id).first()
-    if not product:
+async def run_reservation_expiry(application: Application):
+    """Раз в тик снимает истекшие резервы, убирает товары из корзин и предупреждает пользователей"""
+    while True:
+        await asyncio.sleep(RESERVATION_TICK)
+        try:
+            expired = expire_reservations()
+            if not expired:
+                continue
+
+            by_user = {}
+            for user_id, product_id in expired:
+                by_user.setdefault(user_id, set()).add(product_id)
+
+            for user_id, product_ids in by_user.items():
+                names = [item.product_name for item in cart_store.get(user_id) if item.product_id in product_ids]
+                for product_id in product_ids:
+                    cart_store.remove(user_id, product_id)
+                if names:
+                    start_background_task(notify_reservation_expired(application.bot, user_id, names))
+        except Exception as e:
+            logger.error("Ошибка при снятии истекших резервов: %s", e)
+
+async def notify_reservation_expired(bot, user_id, names):
+    text = (
+        "⏰ Время резерва истекло, из корзины убраны:\n"
+        + "\n".join(f"• {name}" for name in names)
+        + "\n\nДобавьте товары снова, если они еще нужны."
+    )
+    try:
+        await send_limited(bot, user_id, text=text, reply_markup=get_main_keyboard(user_id))
+    except Exception as e:
+        logger.error("Ошибка при отправке уведомления об истекшем резерве %s: %s", user_id, e)
+
+def rebuild_slot_availability():
+    """Пересчитывает индекс свободных мест на DELIVERY_DAYS_AHEAD дней двумя запросами"""
+    today = datetime.now().date()
+    days = [today + timedelta(days=offset) for offset in range(DELIVERY_DAYS_AHEAD + 1)]
+
+    def load():
+        session = Session()
+        try:
+            slots = session.query(DeliverySlot).filter(DeliverySlot.is_active == True).order_by(DeliverySlot.start_hour).all()
+            instances = session.query(SlotInstance).filter(SlotInstance.day >= days[0], SlotInstance.day <= days[-1]).all()
+            return slots, instances
+        finally:
+            session.close()
+
+    slots, instances = run_db(load)
+
+    booked = {(instance.slot_id, instance.day): instance for instance in instances}
+    index = {}
+    for day in days:
+        index[day] = {}
+        for slot in slots:
+            instance = booked.get((slot.id, day))
+            index[day][slot.id] = {
+                'label': f"{slot.start_hour}:00 - {slot.end_hour}:00",
+                'start_hour': slot.start_hour,
+                'capacity': instance.capacity if instance else slot.capacity,
+                'booked': instance.booked if instance else 0
+            }
+
+    with slot_cache_lock:
+        slot_availability['loaded_at'] = time.time()
+        slot_availability['days'] = index
+
+    return index
+
+def get_slot_availability():
+    """Возвращает индекс свободных мест из кэша (перестраивается раз в SLOT_CACHE_TTL)"""
+    with slot_cache_lock:
+        if time.time() - slot_availability['loaded_at'] < SLOT_CACHE_TTL:
+            return slot_availability['days']
+    return rebuild_slot_availability()
+
+def is_slot_open(day, start_hour):
+    """Можно ли еще записаться на слот: день в окне доставки и слот не начался"""
+    now = datetime.now()
+    today = now.date()
+    if day < today or day > today + timedelta(days=DELIVERY_DAYS_AHEAD):
+        return False
+    return day != today or start_hour > now.hour
+
+def get_free_slots(day):
+    """Список (slot_id, label, осталось мест) на дату day без уже начавшихся слотов"""
+    free = []
+    for slot_id, slot in get_slot_availability().get(day, {}).items():
+        if not is_slot_open(day, slot['start_hour']):
+            continue
+        remaining = slot['capacity'] - slot['booked']
+        if remaining > 0:
+            free.append((slot_id, slot['label'], remaining))
+    return free
+
+def update_slot_availability(day, slot_id, delta):
+    """Поправляет индекс после бронирования/освобождения места, не перечитывая БД"""
+    with slot_cache_lock:
+        slot = slot_availability['days'].get(day, {}).get(slot_id)
+        if slot:
+            slot['booked'] = max(0, slot['booked'] + delta)
+
+def invalidate_slot_availability():
+    with slot_cache_lock:
+        slot_availability['loaded_at'] = 0
+
+def format_day(day):
+    today = datetime.now().date()
+    if day == today:
+        return f"Сегодня, {day.strftime('%d.%m')}"
+    if day == today + timedelta(days=1):
+        return f"Завтра, {day.strftime('%d.%m')}"
+    return f"{WEEKDAYS[day.weekday()]}, {day.strftime('%d.%m')}"
+
+def format_delivery(order, absolute=False):
+    """Дата и время доставки заказа для вывода пользователю и администратору.
+
+    absolute=True — дата с годом без «Сегодня»/«Завтра», для текста, который кэшируется.
+    """
+    if order.delivery_date:
+        day = order.delivery_date.strftime('%d.%m.%Y') if absolute else format_day(order.delivery_date)
+        return f"{day} {order.delivery_slot}"
+    return order.delivery_slot
+
+def get_days_keyboard():
+    today = datetime.now().date()
+    keyboard = []
+    for offset in range(DELIVERY_DAYS_AHEAD + 1):
+        day = today + timedelta(days=offset)
+        if get_free_slots(day):
+            keyboard.append([InlineKeyboardButton(f"📅 {format_day(day)}", callback_data=encode_callback(CB_DAY, day.toordinal()))])
+    return keyboard
+
+def get_slots_keyboard(day):
+    keyboard = []
+    for slot_id, label, remaining in get_free_slots(day):
+        keyboard.append([InlineKeyboardButton(f"{label} (мест: {remaining})", callback_data=encode_callback(CB_SLOT, slot_id, day.toordinal()))])
+    if keyboard:
+        keyboard.append([InlineKeyboardButton("« Другой день", callback_data=CB_DAY_LIST)])
+    return keyboard
+
+def get_rebooking_keyboard(day):
+    """Другие слоты того же дня, а если их нет — выбор дня"""
+    return get_slots_keyboard(day) or get_days_keyboard()
+
+def get_catalog():
+    """Доступные товары из кэша; после изменения товаров вызывается invalidate_catalog()"""
+    with catalog_cache_lock:
+        if catalog_cache['products'] is not None and time.time() - catalog_cache['loaded_at'] < CATALOG_CACHE_TTL:
+            return catalog_cache['products']
+
+    try:
+        products = run_db(load_catalog)
+    except DatabaseUnavailable:
+        # Пока БД недоступна, показываем последнюю известную витрину
+        with catalog_cache_lock:
+            stale = catalog_cache['products']
+        if stale is None:
+            raise
+        count_db('stale_catalog')
+        return stale
+
+    with catalog_cache_lock:
+        catalog_cache['products'] = products
+        catalog_cache['loaded_at'] = time.time()
+    return products
+
+def load_catalog():
+    session = ReadSession('catalog')
+    try:
+        return session.query(Product).filter(Product.is_available == True, Product.quantity > 0).order_by(Product.id).all()
+    finally:
+        session.close()
+
+def load_product(product_id, primary=False):
+    # Остатки для резервов читаем с primary: реплика может отставать
+    session = Session() if primary else ReadSession('catalog')
+    try:
+        return session.query(Product).filter(Product.id == product_id).first()
+    finally:
         session.close()
+
+def get_product(product_id, primary=False):
+    return run_db(load_product, product_id, primary)
+
+def invalidate_catalog():
+    # Следующая загрузка каталога пойдет с основной БД, а не с отстающей реплики
+    mark_written('catalog')
+    with catalog_cache_lock:
+        catalog_cache['loaded_at'] = 0
+
+def sum_item_quantities(items, sign):
+    """{product_id: изменение остатка} по позициям заказа"""
+    quantities = {}
+    for item in items:
+        if item.product_id:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + sign * item.quantity
+    return quantities
+
+def after_stock_change(bot, changes):
+    """Вызывается после коммита изменения остатков: сбрасывает витрину и предупреждает администраторов"""
+    invalidate_catalog()
+    low = [(name, quantity, threshold) for name, quantity, threshold, change in changes if change == 'low']
+    if low:
+        start_background_task(notify_low_stock(bot, low))
+
+async def notify_low_stock(bot, products):
+    lines = [f"• {name} — осталось {quantity} шт. (порог {threshold})" for name, quantity, threshold in products]
+    text = "⚠️ Товар заканчивается и скрыт из каталога:\n" + "\n".join(lines) + "\n\nИзменить порог: /threshold НАЗВАНИЕ КОЛИЧЕСТВО"
+    admin_ids = [user_id for user_id, role in get_roles().items() if role == ROLE_ADMIN]
+    await broadcast(bot, admin_ids, text=text)
+
+def get_available_quantity(product_id, user_id=None, primary=False):
+    """Свободный остаток; с user_id — сколько доступно этому пользователю с учетом его резерва"""
+    product = get_product(product_id, primary)
+    if not product:
         return 0
 
-    locked = get_locked_quantity(product_id)
-    available = max(0, product.quantity - locked)
-    session.close()
-    return available
+    locked = get_locked_quantity(product_id, exclude_user_id=user_id)
+    return max(0, product.quantity - locked)
 
 # ========== ОСНОВНЫЕ КОМАНДЫ ==========
 
+WELCOME_TEXT = "Здравствуйте!\nЗдесь вы можете заказать свежие овощи, фрукты и ягоды с доставкой до двери!🍅🍉🍒"
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    welcome_text = "Здравствуйте!\nЗдесь вы можете заказать свежие овощи, фрукты и ягоды с доставкой до двери!🍅🍉🍒"
-    await update.message.reply_text(welcome_text, reply_markup=get_main_keyboard(user_id))
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=get_main_keyboard(user_id))
 
 async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id != ADMIN_ID:
+    if not is_staff(user_id):
         return
-    await update.message.reply_text("👨‍💼 Админ-панель:", reply_markup=get_admin_keyboard())
+    await update.message.reply_text("👨‍💼 Админ-панель:", reply_markup=get_panel_keyboard(user_id))
 
 async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    if query.from_user.id != ADMIN_ID:
+    if not is_staff(query.from_user.id):
         return
-    await query.edit_message_text("👨‍💼 Админ-панель:", reply_markup=get_admin_keyboard())
+    await query.edit_message_text("👨‍💼 Админ-панель:", reply_markup=get_panel_keyboard(query.from_user.id))
 
 async def back_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    if query.from_user.id != ADMIN_ID:
+    if not is_staff(query.from_user.id):
         return
-    await query.edit_message_text("👨‍💼 Админ-панель:", reply_markup=get_admin_keyboard())
+    await query.edit_message_text("👨‍💼 Админ-панель:", reply_markup=get_panel_keyboard(query.from_user.id))
 
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    welcome_text = "Здравствуйте!\nЗдесь вы можете заказать свежие овощи, фрукты и ягоды с доставкой до двери!🍅🍉🍒"
-    await query.edit_message_text(welcome_text, reply_markup=get_main_keyboard(user_id))
+    await query.edit_message_text(WELCOME_TEXT, reply_markup=get_main_keyboard(user_id))
+
+async def stale_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка, которую не разобрал ни один обработчик (старый формат или завершенный диалог): снимаем часики и показываем меню"""
+    query = update.callback_query
+    await query.answer("Эта кнопка устарела.")
+    user_id = query.from_user.id
+    await context.bot.send_message(chat_id=user_id, text=WELCOME_TEXT, reply_markup=get_main_keyboard(user_id))
 
 # ========== ФУНКЦИИ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ==========
 
 async def show_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    session = Session()
-    products = session.query(Product).filter(Product.is_available == True, Product.quantity > 0).all()
-    session.close()
+    products = await asyncio.to_thread(get_catalog)
 
     if not products:
         await query.edit_message_text("🍃 Товаров пока нет в наличии.", reply_markup=get_main_keyboard(query.from_user.id))
@@ -160,83 +1246,82 @@ async def show_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
         emoji = "🥒" if p.category == "Овощи" else "🍉" if p.category == "Фрукты" else "🍒"
         text += f"{emoji} {p.name} — *{p.price_per_kg} р/кг* — Осталось {p.quantity} шт.\n"
 
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_main")]]
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_MAIN)]]
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     keyboard = [
-        [InlineKeyboardButton("🥒 Овощи", callback_data="cat_Овощи")],
-        [InlineKeyboardButton("🍉 Фрукты", callback_data="cat_Фрукты")],
-        [InlineKeyboardButton("🍒 Ягоды", callback_data="cat_Ягоды")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
+        [InlineKeyboardButton("🥒 Овощи", callback_data=encode_callback(CB_CATEGORY, CATEGORIES.index("Овощи")))],
+        [InlineKeyboardButton("🍉 Фрукты", callback_data=encode_callback(CB_CATEGORY, CATEGORIES.index("Фрукты")))],
+        [InlineKeyboardButton("🍒 Ягоды", callback_data=encode_callback(CB_CATEGORY, CATEGORIES.index("Ягоды")))],
+        [InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_MAIN)]
     ]
     await query.edit_message_text("🌿 Выберите категорию:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def show_category_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    category = query.data.replace("cat_", "")
+    if context.args[0] >= len(CATEGORIES):
+        return
+    category = CATEGORIES[context.args[0]]
     context.user_data['category'] = category
 
-    session = Session()
-    products = session.query(Product).filter(
-        Product.category == category,
-        Product.is_available == True,
-        Product.quantity > 0
-    ).all()
-    session.close()
+    products = [p for p in await asyncio.to_thread(get_catalog) if p.category == category]
 
     if not products:
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="order")]]
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data=CB_CATALOG)]]
         await query.edit_message_text(f"🍃 В категории '{category}' пока нет товаров.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
     keyboard = []
     category_emoji = "🥒" if category == "Овощи" else "🍉" if category == "Фрукты" else "🍒"
     for p in products:
-        keyboard.append([InlineKeyboardButton(f"{category_emoji} {p.name} — {p.price_per_kg} р/кг", callback_data=f"prod_{p.id}")])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="order")])
+        keyboard.append([InlineKeyboardButton(f"{category_emoji} {p.name} — {p.price_per_kg} р/кг", callback_data=encode_callback(CB_PRODUCT, p.id))])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=CB_CATALOG)])
 
     await query.edit_message_text(f"✨ Категория: {category}", reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def show_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    product_id = int(query.data.replace("prod_", ""))
+    product_id = context.args[0]
     context.user_data['current_product'] = product_id
     context.user_data['selected_qty'] = 1
 
-    session = Session()
-    product = session.query(Product).filter(Product.id == product_id).first()
-    session.close()
+    product = await asyncio.to_thread(get_product, product_id)
 
     if not product or product.quantity <= 0:
-        await query.edit_message_text("Товар закончился.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Назад", callback_data="order")]]))
+        await query.edit_message_text("Товар закончился.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Назад", callback_data=CB_CATALOG)]]))
         return
 
     await show_product_card(query, product, 1)
 
-async def show_product_card(query, product, selected_qty):
-    category_emoji = "🥒" if product.category == "Овощи" else "🍉" if product.category == "Фрукты" else "🍒"
-    available_qty = get_available_quantity(product.id)
-    text = f"{category_emoji} *{product.name}*\n\n💰 *Цена: {product.price_per_kg} р/кг*\n📦 Доступно: {available_qty} шт.\n\n⚠️ *Внимание!* Выберите количество товара в штуках.\n\n✅ Выбрано: {selected_qty} шт."
-    keyboard = [
+def get_quantity_keyboard(product, selected_qty):
+    """Кнопки количества несут итоговое число, поэтому обработчику не нужно знать, какая нажата"""
+    back = encode_callback(CB_CATEGORY, CATEGORIES.index(product.category)) if product.category in CATEGORIES else CB_CATALOG
+    return [
         [
-            InlineKeyboardButton("1️⃣", callback_data="qty_1"),
-            InlineKeyboardButton("2️⃣", callback_data="qty_2"),
-            InlineKeyboardButton("3️⃣", callback_data="qty_3"),
-            InlineKeyboardButton("4️⃣", callback_data="qty_4")
+            InlineKeyboardButton("1️⃣", callback_data=encode_callback(CB_QTY, 1)),
+            InlineKeyboardButton("2️⃣", callback_data=encode_callback(CB_QTY, 2)),
+            InlineKeyboardButton("3️⃣", callback_data=encode_callback(CB_QTY, 3)),
+            InlineKeyboardButton("4️⃣", callback_data=encode_callback(CB_QTY, 4))
         ],
         [
-            InlineKeyboardButton("➖1", callback_data="qty_minus"),
-            InlineKeyboardButton("➕1", callback_data="qty_plus")
+            InlineKeyboardButton("➖1", callback_data=encode_callback(CB_QTY, max(1, selected_qty - 1))),
+            InlineKeyboardButton("➕1", callback_data=encode_callback(CB_QTY, selected_qty + 1))
         ],
-        [InlineKeyboardButton("🛒 В корзину", callback_data="add_to_cart")],
-        [InlineKeyboardButton("🔙 Назад", callback_data=f"cat_{product.category}")]
+        [InlineKeyboardButton("🛒 В корзину", callback_data=CB_ADD_TO_CART)],
+        [InlineKeyboardButton("🔙 Назад", callback_data=back)]
     ]
 
+async def show_product_card(query, product, selected_qty):
+    category_emoji = "🥒" if product.category == "Овощи" else "🍉" if product.category == "Фрукты" else "🍒"
+    available_qty = await asyncio.to_thread(get_available_quantity, product.id)
+    text = f"{category_emoji} *{product.name}*\n\n💰 *Цена: {product.price_per_kg} р/кг*\n📦 Доступно: {available_qty} шт.\n\n⚠️ *Внимание!* Выберите количество товара в штуках.\n\n✅ Выбрано: {selected_qty} шт."
+    keyboard = get_quantity_keyboard(product, selected_qty)
+
     if product.photo_id:
         try:
             await query.message.delete()
@@ -246,7 +1331,7 @@ async def show_product_card(query, product, selected_qty):
                 parse_mode='Markdown',
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
-        except:
+        except BadRequest:
             await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
     else:
         await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
@@ -258,49 +1343,26 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not product_id:
         return
 
-    session = Session()
-    product = session.query(Product).filter(Product.id == product_id).first()
-    session.close()
+    product = await asyncio.to_thread(get_product, product_id)
 
     if not product:
         return
 
-    current_qty = context.user_data.get('selected_qty', 1)
-
-    if query.data == "qty_minus":
-        current_qty = max(1, current_qty - 1)
-    elif query.data == "qty_plus":
-        available_qty = get_available_quantity(product_id)
-        current_qty = min(available_qty, current_qty + 1)
-    elif query.data.startswith("qty_"):
-        available_qty = get_available_quantity(product_id)
-        current_qty = min(available_qty, int(query.data.replace("qty_", "")))
+    available_qty = await asyncio.to_thread(get_available_quantity, product_id)
+    current_qty = max(1, min(available_qty, context.args[0]))
 
     context.user_data['selected_qty'] = current_qty
     category_emoji = "🥒" if product.category == "Овощи" else "🍉" if product.category == "Фрукты" else "🍒"
-    available_qty = get_available_quantity(product_id)
     text = f"{category_emoji} *{product.name}*\n\n💰 *Цена: {product.price_per_kg} р/кг*\n📦 Доступно: {available_qty} шт.\n\n⚠️ *Внимание!* Выберите количество товара в штуках.\n\n✅ Выбрано: {current_qty} шт."
-    keyboard = [
-        [
-            InlineKeyboardButton("1️⃣", callback_data="qty_1"),
-            InlineKeyboardButton("2️⃣", callback_data="qty_2"),
-            InlineKeyboardButton("3️⃣", callback_data="qty_3"),
-            InlineKeyboardButton("4️⃣", callback_data="qty_4")
-        ],
-        [
-            InlineKeyboardButton("➖1", callback_data="qty_minus"),
-            InlineKeyboardButton("➕1", callback_data="qty_plus")
-        ],
-        [InlineKeyboardButton("🛒 В корзину", callback_data="add_to_cart")],
-        [InlineKeyboardButton("🔙 Назад", callback_data=f"cat_{product.category}")]
-    ]
+    keyboard = get_quantity_keyboard(product, current_qty)
 
     try:
         await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
-    except:
+    except BadRequest:
+        # Карточка с фото: текста нет, редактируем подпись; «not modified» при повторном нажатии не важно
         try:
             await query.edit_message_caption(caption=text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
-        except:
+        except BadRequest:
             pass
 
 async def add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -310,84 +1372,66 @@ async def add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     qty = context.user_data.get('selected_qty', 1)
     user_id = query.from_user.id
 
-    if not lock_product(product_id, user_id, qty):
+    product = await asyncio.to_thread(get_product, product_id, True)
+
+    if not product or not lock_product(product_id, user_id, qty, product.quantity):
         await query.answer("Товар временно недоступен. Попробуйте позже!", show_alert=True)
         return
 
-    session = Session()
-    product = session.query(Product).filter(Product.id == product_id).first()
-
-    if product:
-        existing = session.query(Cart).filter(Cart.user_id == user_id, Cart.product_id == product_id).first()
-        if existing:
-            existing.quantity += qty
-        else:
-            cart_item = Cart(
-                user_id=user_id,
-                product_id=product_id,
-                product_name=product.name,
-                quantity=qty,
-                price_per_kg=product.price_per_kg
-            )
-            session.add(cart_item)
-        session.commit()
-    session.close()
+    cart_store.add(user_id, product, qty)
 
     await query.answer("Товар добавлен в корзину!")
     await show_cart(query, user_id)
 
-async def show_cart(query, user_id):
-    session = Session()
-    cart_items = session.query(Cart).filter(Cart.user_id == user_id).all()
-    session.close()
+async def show_cart(query, user_id, notice=""):
+    touch_reservations(user_id)
+    cart_items = cart_store.get(user_id)
 
     if not cart_items:
-        keyboard = [[InlineKeyboardButton("« Назад", callback_data="back_main")]]
-        await query.edit_message_text("Ваша корзина пуста.", reply_markup=InlineKeyboardMarkup(keyboard))
+        keyboard = [[InlineKeyboardButton("« Назад", callback_data=CB_BACK_MAIN)]]
+        await query.edit_message_text(notice + "Ваша корзина пуста.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
-    text = "🛒 Ваша корзина:\n\n"
+    text = notice + "🛒 Ваша корзина:\n\n"
     for item in cart_items:
         text += f"• {item.product_name} x{item.quantity} шт.\n"
-    text += "\nℹ️ Итоговая стоимость будет рассчитана при доставке."
+    text += "\nℹ️ Итоговая стоимость будет рассчитана при доставке по фактическому весу, вместе с заказом придет накладная."
 
     keyboard = [
-        [InlineKeyboardButton("✅ Оформить заказ", callback_data="checkout")],
-        [InlineKeyboardButton("🔄 Продолжить покупки", callback_data="order")],
-        [InlineKeyboardButton("🗑 Очистить корзину", callback_data="clear_cart")]
+        [InlineKeyboardButton("✅ Оформить заказ", callback_data=CB_CHECKOUT)],
+        [InlineKeyboardButton("🔄 Продолжить покупки", callback_data=CB_CATALOG)],
+        [InlineKeyboardButton("🗑 Очистить корзину", callback_data=CB_CLEAR_CART)]
     ]
 
     try:
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-    except:
+    except BadRequest:
         await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer("Корзина очищена!")
     user_id = query.from_user.id
-    session = Session()
-    cart_items = session.query(Cart).filter(Cart.user_id == user_id).all()
 
-    for item in cart_items:
+    for item in cart_store.get(user_id):
         unlock_product(item.product_id, user_id)
 
-    session.query(Cart).filter(Cart.user_id == user_id).delete()
-    session.commit()
-    session.close()
+    cart_store.clear(user_id)
 
-    keyboard = [[InlineKeyboardButton("« Назад", callback_data="back_main")]]
+    keyboard = [[InlineKeyboardButton("« Назад", callback_data=CB_BACK_MAIN)]]
     await query.edit_message_text("Корзина очищена.", reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def checkout_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
+    touch_reservations(user_id)
+    cart_items = cart_store.get(user_id)
     session = Session()
-    cart_items = session.query(Cart).filter(Cart.user_id == user_id).all()
 
     for item in cart_items:
-        available_qty = get_available_quantity(item.product_id)
+        # Собственный резерв пользователя не мешает оформить его же корзину
+        available_qty = await asyncio.to_thread(get_available_quantity, item.product_id, user_id, True)
         if available_qty < item.quantity:
             product = session.query(Product).filter(Product.id == item.product_id).first()
             if product:
@@ -406,122 +1450,249 @@ async def checkout_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Корзина пуста.", reply_markup=get_main_keyboard(query.from_user.id))
         return ConversationHandler.END
 
+    # Сохраняем корзину в БД до того, как пользователь начнет вводить адрес
+    cart_store.flush([user_id])
+
+    # Повторная доставка колбэка слота или двойное нажатие дают тот же ключ,
+    # поэтому в рамках одного оформления может быть создан только один заказ
+    context.user_data['checkout_key'] = f"{user_id}:{query.id}"
+
     await query.edit_message_text("📍 Введите адрес доставки:")
     return ORDER_ADDRESS
 
 async def get_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['address'] = update.message.text
+    touch_reservations(update.effective_user.id)
     await update.message.reply_text("📞 Введите номер телефона для связи:")
     return ORDER_PHONE
 
 async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['phone'] = update.message.text
-    session = Session()
-    slots = session.query(DeliverySlot).filter(DeliverySlot.is_active == True).all()
-    session.close()
+    touch_reservations(update.effective_user.id)
+    keyboard = await asyncio.to_thread(get_days_keyboard)
 
-    if not slots:
+    if not keyboard:
         await update.message.reply_text("Нет доступных слотов доставки.", reply_markup=get_main_keyboard(update.effective_user.id))
         return ConversationHandler.END
 
-    keyboard = []
-    for slot in slots:
-        keyboard.append([InlineKeyboardButton(f"{slot.start_hour}:00 - {slot.end_hour}:00", callback_data=f"slot_{slot.id}")])
-
     await update.message.reply_text(
-        "🕐 Выберите время доставки:\n\n"
-        "⚠️ *Внимание!* Доставка осуществляется только на *СЕГОДНЯШНИЙ ДЕНЬ*!",
-        parse_mode='Markdown',
+        "📅 Выберите день доставки:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     return ORDER_SLOT
 
-async def send_order_notification_to_admin(context: ContextTypes.DEFAULT_TYPE, order: Order):
-    if ADMIN_ID == 0:
-        logger.warning("ADMIN_ID не установлен, уведомление не отправлено")
-        return
+async def select_delivery_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    touch_reservations(query.from_user.id)
+
+    if not context.args:
+        keyboard = await asyncio.to_thread(get_days_keyboard)
+        if not keyboard:
+            await query.edit_message_text("Свободных слотов доставки не осталось.", reply_markup=get_main_keyboard(query.from_user.id))
+            return ConversationHandler.END
+        await query.edit_message_text("📅 Выберите день доставки:", reply_markup=InlineKeyboardMarkup(keyboard))
+        return ORDER_SLOT
+
+    day = date.fromordinal(context.args[0])
+    keyboard = await asyncio.to_thread(get_slots_keyboard, day)
+
+    if not keyboard:
+        keyboard = await asyncio.to_thread(get_days_keyboard)
+        await query.edit_message_text(
+            "На этот день свободных слотов нет. Выберите другой день:",
+            reply_markup=InlineKeyboardMarkup(keyboard or [[InlineKeyboardButton("« Назад", callback_data=CB_BACK_MAIN)]])
+        )
+        return ORDER_SLOT
 
-    try:
-        text = f"🆕 *Новый заказ!* #{order.id}\n\n"
-        text += f"👤 Пользователь: {order.user_name}\n"
-        text += f"📞 Телефон: {order.phone}\n"
-        text += f"📍 Адрес: {order.address}\n"
-        text += f"🕐 Время доставки: {order.delivery_slot}\n"
-        text += f"📅 Дата создания: {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-        text += f"📋 Статус: *Ожидает подтверждения*\n\n"
-        text += "*Товары:*\n"
+    await query.edit_message_text(
+        f"🕐 Выберите время доставки на *{format_day(day)}*:",
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return ORDER_SLOT
 
-        session = Session()
-        order_items = session.query(OrderItem).filter(OrderItem.order_id == order.id).all()
+async def send_order_notification_to_admin(bot, order: Order):
+    """Рассылает новый заказ всем диспетчерам; принять его сможет только один"""
+    staff_ids = get_staff_ids()
+    if not staff_ids:
+        logger.warning("Администраторы не назначены, уведомление не отправлено")
+        return
 
-        for item in order_items:
-            text += f"• {item.product_name} x{item.quantity}\n"
+    text = f"🆕 *Новый заказ!* #{order.id}\n\n"
+    text += f"👤 Пользователь: {order.user_name}\n"
+    text += f"📞 Телефон: {order.phone}\n"
+    text += f"📍 Адрес: {order.address}\n"
+    text += f"🕐 Время доставки: {format_delivery(order)}\n"
+    text += f"📅 Дата создания: {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+    text += f"📋 Статус: *Ожидает подтверждения*\n\n"
+    text += "*Товары:*\n"
 
-        session.close()
+    for item in order.items:
+        text += f"• {item.product_name} x{item.quantity}\n"
 
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Подтвердить", callback_data=f"admin_accept_{order.id}"),
-                InlineKeyboardButton("❌ Отменить", callback_data=f"admin_cancel_{order.id}")
-            ],
-            [InlineKeyboardButton("📋 Все заказы", callback_data="admin_orders")]
-        ]
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Подтвердить", callback_data=encode_callback(CB_ACCEPT, order.id)),
+            InlineKeyboardButton("❌ Отменить", callback_data=encode_callback(CB_CANCEL, order.id))
+        ],
+        [InlineKeyboardButton("📋 Все заказы", callback_data=CB_ADMIN_ORDERS)]
+    ]
 
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=text,
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления администратору: {e}")
+    sent = await broadcast(
+        bot,
+        staff_ids,
+        text=text,
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    if not sent:
+        raise RuntimeError(f"уведомление о заказе #{order.id} не доставлено ни одному диспетчеру")
+    order_notifications[order.id] = [(chat_id, message.message_id) for chat_id, message in sent]
+
+async def close_order_notifications(bot, order_id, handled_by, label):
+    """Заменяет кнопки в уведомлениях о заказе у остальных диспетчеров на отметку label"""
+    messages = [(chat_id, message_id) for chat_id, message_id in order_notifications.pop(order_id, []) if chat_id != handled_by]
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=CB_ADMIN_ORDERS)]])
+
+    async def edit(chat_id, message_id):
+        async with notify_limiter:
+            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+
+    results = await asyncio.gather(*(edit(chat_id, message_id) for chat_id, message_id in messages), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Ошибка при обновлении уведомления о заказе #%s: %s", order_id, result)
+
+async def reply_checkout_duplicate(query, order_id):
+    """Ответ на повторный колбэк оформления: заказ уже создан или корзина пуста"""
+    if order_id:
+        text = f"✅ Заказ #{order_id} уже оформлен и ожидает подтверждения."
+    else:
+        text = "Корзина пуста."
+    try:
+        await query.edit_message_text(text, reply_markup=get_main_keyboard(query.from_user.id))
+    except BadRequest:
+        # Сообщение уже показывает этот текст
+        pass
 
 async def select_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    slot_id = int(query.data.replace("slot_", ""))
+    slot_id, day = context.args
+    day = date.fromordinal(day)
     user_id = query.from_user.id
+    checkout_key = context.user_data.get('checkout_key') or f"{user_id}:{query.id}"
 
     session = Session()
+    existing_order_id = session.query(Order.id).filter(Order.checkout_key == checkout_key).scalar()
+    cart_items = cart_store.get(user_id)
+
+    if existing_order_id or not cart_items:
+        session.close()
+        await reply_checkout_duplicate(query, existing_order_id)
+        return ConversationHandler.END
+
     slot = session.query(DeliverySlot).filter(DeliverySlot.id == slot_id).first()
-    cart_items = session.query(Cart).filter(Cart.user_id == user_id).all()
+    # Клавиатура могла устареть: день уже прошел или слот начался
+    slot_open = slot is not None and is_slot_open(day, slot.start_hour)
+    instance = book_slot(session, slot_id, day) if slot_open else None
+
+    if not instance:
+        session.rollback()
+        session.close()
+        invalidate_slot_availability()
+        keyboard = await asyncio.to_thread(get_rebooking_keyboard, day)
+        if not keyboard:
+            await query.edit_message_text("Свободных слотов доставки не осталось.", reply_markup=get_main_keyboard(user_id))
+            return ConversationHandler.END
+        reason = "В этом слоте не осталось мест" if slot_open else "Это время доставки уже недоступно"
+        await query.edit_message_text(
+            f"❌ {reason}. Выберите другое время доставки:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return ORDER_SLOT
 
     order = Order(
         user_id=user_id,
         user_name=query.from_user.full_name,
         delivery_slot=f"{slot.start_hour}:00 - {slot.end_hour}:00",
+        slot_id=slot_id,
+        slot_instance_id=instance.id,
+        delivery_date=day,
         address=context.user_data.get('address'),
         phone=context.user_data.get('phone'),
-        status='pending'
+        status='pending',
+        checkout_key=checkout_key,
+        stock_written_off=True
     )
-    session.add(order)
-    session.flush()
+    # Уникальный checkout_key проверяется при вставке: параллельный повтор того же колбэка
+    # успел создать заказ первым — отдаем его вместо второго
+    try:
+        with session.begin_nested():
+            session.add(order)
+            session.flush()
+    except IntegrityError:
+        session.rollback()
+        existing_order_id = session.query(Order.id).filter(Order.checkout_key == checkout_key).scalar()
+        session.close()
+        await reply_checkout_duplicate(query, existing_order_id)
+        return ConversationHandler.END
 
+    order_items = []
     for item in cart_items:
         order_item = OrderItem(
             order_id=order.id,
             product_id=item.product_id,
-            product_name=item.product_name,
             quantity=item.quantity,
-            price_per_kg=item.price_per_kg
+            **line_price_fields(item.version_id, item.product_name, item.price_per_kg)
         )
         session.add(order_item)
-        unlock_product(item.product_id, user_id)
+        order_items.append(order_item)
+    # После flush у позиций подгружаются версии товара — из них берутся названия для статистики
+    session.flush()
+
+    # Товар списывается при оформлении и возвращается на склад при отмене
+    try:
+        stock_changes = change_stock(session, sum_item_quantities(order_items, -1))
+    except OutOfStock as e:
+        session.rollback()
+        session.close()
+        invalidate_slot_availability()
+        invalidate_catalog()
+        names = [item.product_name for item in cart_items if item.product_id in e.product_ids]
+        await query.edit_message_text(
+            "❌ Этих товаров уже не хватает: " + ", ".join(names) + ".\nИзмените количество в корзине и оформите заказ снова.",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return ConversationHandler.END
 
+    record_order_stats(session, order, 'pending', order_items, order.created_at)
+    add_order_event(session, order.id, 'created')
     session.query(Cart).filter(Cart.user_id == user_id).delete()
     session.commit()
-
-    # Отправляем уведомление администратору
-    await send_order_notification_to_admin(context, order)
-
+    # Резерв больше не нужен: товар уже списан со склада
+    for item in cart_items:
+        unlock_product(item.product_id, user_id)
+    cart_store.clear(user_id, persisted=True)
+    mark_written(user_id)
+    after_stock_change(context.bot, stock_changes)
+    update_slot_availability(day, slot_id, 1)
+    request_board_refresh(context.application)
+    # Уведомление администраторам отправит диспетчер outbox
+    wake_outbox()
+
+    # После commit атрибуты заказа перечитываются, поэтому берем их до закрытия сессии
+    order_id = order.id
+    delivery_text = format_delivery(order)
     session.close()
 
     # Отправляем сообщение клиенту о том, что заказ ожидает подтверждения
     await query.edit_message_text(
-        f"✅ *Заказ #{order.id} оформлен!*\n\n"
+        f"✅ *Заказ #{order_id} оформлен!*\n\n"
         f"📍 *Адрес:* {context.user_data.get('address')}\n"
         f"📞 *Телефон:* {context.user_data.get('phone')}\n"
-        f"🕐 *Доставка:* {slot.start_hour}:00 - {slot.end_hour}:00\n\n"
+        f"🕐 *Доставка:* {delivery_text}\n\n"
         "📋 *Ваш заказ ожидает подтверждения администратором.*\n"
         "Вы получите уведомление, когда заказ будет подтвержден.\n\n"
         "⏳ Обычно это занимает не более 15 минут.",
@@ -539,58 +1710,182 @@ async def select_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return ConversationHandler.END
 
-async def show_my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    session = Session()
-    orders = session.query(Order).filter(Order.user_id == user_id).order_by(Order.created_at.desc()).limit(10).all()
-
-    if not orders:
-        session.close()
-        keyboard = [[InlineKeyboardButton("« Назад", callback_data="back_main")]]
-        await query.edit_message_text("У вас нет заказов.", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+def format_user_order(order):
+    """Карточка заказа в истории пользователя; order.items должны быть загружены"""
+    status_emoji = {
+        'pending': '⏳',
+        'active': '✅',
+        'on_the_way': '🚗',
+        'delivered': '🎉',
+        'cancelled': '❌'
+    }.get(order.status, '❓')
 
-    text = "📦 *ВАШИ ЗАКАЗЫ*\n\n"
+    status_text = {
+        'pending': 'Ожидает подтверждения',
+        'active': 'Подтвержден',
+        'on_the_way': 'Курьер направляется',
+        'delivered': 'Доставлен',
+        'cancelled': 'Отменен'
+    }.get(order.status, 'Неизвестно')
 
-    for order in orders:
-        status_emoji = {
-            'pending': '⏳',
-            'active': '✅',
-            'on_the_way': '🚗',
-            'delivered': '🎉',
-            'cancelled': '❌'
-        }.get(order.status, '❓')
+    text = f"{status_emoji} *Заказ #{order.id}*\n"
+    text += f"📅 *Дата:* {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+    text += f"📋 *Статус:* {status_text}\n"
+    # Карточки завершенных заказов кэшируются без срока, поэтому без относительных дат
+    text += f"🕐 *Доставка:* {format_delivery(order, absolute=True)}\n"
+    text += f"📍 *Адрес:* {order.address}\n"
 
-        status_text = {
-            'pending': 'Ожидает подтверждения',
-            'active': 'Подтвержден',
-            'on_the_way': 'Курьер направляется',
-            'delivered': 'Доставлен',
-            'cancelled': 'Отменен'
-        }.get(order.status, 'Неизвестно')
+    if order.status == 'on_the_way' and order.on_the_way_at:
+        text += f"🚗 *Вышел:* {order.on_the_way_at.strftime('%H:%M')}\n"
+
+    if order.status == 'delivered' and order.delivered_at:
+        text += f"✅ *Доставлен:* {order.delivered_at.strftime('%H:%M')}\n"
+    if order.total_amount is not None:
+        text += f"💰 *Итого:* {order.total_amount:.2f} р ({order.total_weight_kg:.3f} кг)\n"
+
+    if order.status == 'cancelled' and order.cancel_reason:
+        text += f"📝 *Причина:* {order.cancel_reason}\n"
+
+    for item in order.items:
+        text += f"• {item.product_name} x{item.quantity}\n"
+
+    return text + "─" * 20 + "\n"
+
+def get_cached_user_orders(user_id, order_ids):
+    """Карточки завершенных заказов пользователя из кэша {order_id: текст}"""
+    with my_orders_cache_lock:
+        cached = my_orders_cache.get(user_id)
+        if cached is None:
+            return {}
+        my_orders_cache.move_to_end(user_id)
+        return {order_id: cached[order_id] for order_id in order_ids if order_id in cached}
+
+def cache_user_orders(user_id, rendered):
+    with my_orders_cache_lock:
+        my_orders_cache.setdefault(user_id, {}).update(rendered)
+        my_orders_cache.move_to_end(user_id)
+        while len(my_orders_cache) > MY_ORDERS_CACHE_USERS:
+            my_orders_cache.popitem(last=False)
+
+def load_user_orders_page(user_id, before_id=None):
+    """Страница истории: (список (id, текст), есть ли заказы старее).
+
+    Сначала выбираются только id и статусы страницы; полные заказы с позициями
+    догружаются одним запросом лишь для тех, чьих карточек нет в кэше.
+    """
+    session = ReadSession(user_id)
+    try:
+        # Архив хранит исходные id, поэтому одна лента по id охватывает обе таблицы
+        pages = []
+        for model, archived in ((Order, False), (ArchivedOrder, True)):
+            page_query = select(model.id, model.status, literal(archived).label('archived')).where(model.user_id == user_id)
+            if before_id:
+                page_query = page_query.where(model.id < before_id)
+            pages.append(page_query)
+        rows = session.execute(union_all(*pages).order_by(desc('id')).limit(MY_ORDERS_PAGE_SIZE + 1)).all()
+        has_more = len(rows) > MY_ORDERS_PAGE_SIZE
+        rows = rows[:MY_ORDERS_PAGE_SIZE]
+
+        rendered = get_cached_user_orders(user_id, [order_id for order_id, status, _ in rows if status in FINAL_ORDER_STATUSES])
+        for model, archived in ((Order, False), (ArchivedOrder, True)):
+            missing = [order_id for order_id, _, in_archive in rows if order_id not in rendered and bool(in_archive) == archived]
+            if not missing:
+                continue
+            orders = session.query(model).options(selectinload(model.items)).filter(model.id.in_(missing)).all()
+            fresh = {order.id: format_user_order(order) for order in orders}
+            cache_user_orders(user_id, {
+                order.id: fresh[order.id] for order in orders if order.status in FINAL_ORDER_STATUSES
+            })
+            rendered.update(fresh)
+    finally:
+        session.close()
 
-        text += f"{status_emoji} *Заказ #{order.id}*\n"
-        text += f"📅 *Дата:* {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-        text += f"📋 *Статус:* {status_text}\n"
-        text += f"🕐 *Доставка:* {order.delivery_slot}\n"
-        text += f"📍 *Адрес:* {order.address}\n"
+    return [(order_id, rendered[order_id]) for order_id, _, _ in rows if order_id in rendered], has_more
 
-        if order.status == 'on_the_way' and order.on_the_way_at:
-            text += f"🚗 *Вышел:* {order.on_the_way_at.strftime('%H:%M')}\n"
+async def repeat_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кладет в корзину все, что еще есть в наличии из прошлого заказа, и сообщает о нехватке"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    order_id = context.args[0]
+
+    session = ReadSession(user_id)
+    order = None
+    for model in (Order, ArchivedOrder):
+        order = session.query(model).options(selectinload(model.items)).filter(
+            model.id == order_id,
+            model.user_id == user_id
+        ).first()
+        if order:
+            break
+    if not order:
+        session.close()
+        await query.answer("Заказ не найден.", show_alert=True)
+        return
 
-        if order.status == 'delivered' and order.delivered_at:
-            text += f"✅ *Доставлен:* {order.delivered_at.strftime('%H:%M')}\n"
+    wanted = {}
+    for item in order.items:
+        if item.product_id:
+            wanted[item.product_id] = wanted.get(item.product_id, 0) + item.quantity
+    names = {item.product_id: item.product_name for item in order.items}
+    session.close()
+    await query.answer()
 
-        if order.status == 'cancelled' and order.cancel_reason:
-            text += f"📝 *Причина:* {order.cancel_reason}\n"
+    # Одна выборка остатков на все позиции заказа; резервируем по данным primary
+    session = Session()
+    products = {
+        product.id: product
+        for product in session.query(Product).filter(Product.id.in_(list(wanted)), Product.is_available == True)
+    }
+    session.close()
 
-        text += "─" * 20 + "\n"
+    granted = lock_products(user_id, {
+        product_id: (quantity, products[product_id].quantity)
+        for product_id, quantity in wanted.items()
+        if product_id in products
+    })
+    cart_store.add_many(user_id, [(products[product_id], quantity) for product_id, quantity in granted.items()])
+
+    shortfalls = []
+    for product_id, quantity in wanted.items():
+        got = granted.get(product_id, 0)
+        if got == 0:
+            shortfalls.append(f"• {names[product_id]} — нет в наличии")
+        elif got < quantity:
+            shortfalls.append(f"• {names[product_id]} — добавлено {got} из {quantity} шт.")
+
+    notice = f"🔁 Повтор заказа #{order_id}\n"
+    if shortfalls:
+        notice += "Не все товары в наличии:\n" + "\n".join(shortfalls) + "\n"
+    await show_cart(query, user_id, notice + "\n")
 
-    session.close()
+async def show_my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    before_id = context.args[0] if context.args else None
+    page, has_more = load_user_orders_page(user_id, before_id)
+
+    if not page:
+        keyboard = [[InlineKeyboardButton("« Назад", callback_data=CB_BACK_MAIN)]]
+        await query.edit_message_text("У вас нет заказов.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
 
-    keyboard = [[InlineKeyboardButton("« Назад", callback_data="back_main")]]
+    text = "📦 *ВАШИ ЗАКАЗЫ*\n\n" + "".join(order_text for _, order_text in page)
+
+    navigation = []
+    if before_id:
+        navigation.append(InlineKeyboardButton("« Новые", callback_data=CB_MY_ORDERS))
+    if has_more:
+        navigation.append(InlineKeyboardButton("Старее »", callback_data=encode_callback(CB_MY_ORDERS, page[-1][0])))
+
+    repeat_buttons = [
+        InlineKeyboardButton(f"🔁 Повторить #{order_id}", callback_data=encode_callback(CB_REPEAT_ORDER, order_id))
+        for order_id, _ in page
+    ]
+    keyboard = [repeat_buttons[i:i + 2] for i in range(0, len(repeat_buttons), 2)]
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("« Назад", callback_data=CB_BACK_MAIN)])
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
 # ========== ФУНКЦИИ ДЛЯ ДОБАВЛЕНИЯ ТОВАРА (ИСПРАВЛЕННЫЕ) ==========
@@ -599,7 +1894,7 @@ async def admin_add_product_start(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
 
-    if query.from_user.id != ADMIN_ID:
+    if not is_admin(query.from_user.id):
         return
 
     session = Session()
@@ -614,10 +1909,10 @@ async def admin_add_product_start(update: Update, context: ContextTypes.DEFAULT_
     # Предлагаем выбрать из существующих товаров
     keyboard = []
     for product in products:
-        keyboard.append([InlineKeyboardButton(f"{product.name} ({product.category})", callback_data=f"draft_{product.id}")])
+        keyboard.append([InlineKeyboardButton(f"{product.name} ({product.category})", callback_data=encode_callback(CB_DRAFT, product.id))])
 
-    keyboard.append([InlineKeyboardButton("➕ Новый товар", callback_data="new_product")])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
+    keyboard.append([InlineKeyboardButton("➕ Новый товар", callback_data=CB_NEW_PRODUCT)])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_ADMIN)])
 
     await query.edit_message_text(
         "Выберите товар из существующих или создайте новый:",
@@ -629,7 +1924,10 @@ async def select_product_draft(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
 
-    product_id = int(query.data.replace("draft_", ""))
+    if not is_admin(query.from_user.id):
+        return
+
+    product_id = context.args[0]
 
     session = Session()
     product = session.query(Product).filter(Product.id == product_id).first()
@@ -655,6 +1953,9 @@ async def new_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
+    if not is_admin(query.from_user.id):
+        return
+
     # Очищаем старые данные
     context.user_data.pop('new_product_name', None)
     context.user_data.pop('new_product_category', None)
@@ -666,9 +1967,9 @@ async def admin_get_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['new_product_name'] = update.message.text
 
     keyboard = [
-        [InlineKeyboardButton("🥒 Овощи", callback_data="newcat_Овощи")],
-        [InlineKeyboardButton("🍉 Фрукты", callback_data="newcat_Фрукты")],
-        [InlineKeyboardButton("🍒 Ягоды", callback_data="newcat_Ягоды")]
+        [InlineKeyboardButton("🥒 Овощи", callback_data=encode_callback(CB_NEW_CATEGORY, CATEGORIES.index("Овощи")))],
+        [InlineKeyboardButton("🍉 Фрукты", callback_data=encode_callback(CB_NEW_CATEGORY, CATEGORIES.index("Фрукты")))],
+        [InlineKeyboardButton("🍒 Ягоды", callback_data=encode_callback(CB_NEW_CATEGORY, CATEGORIES.index("Ягоды")))]
     ]
 
     await update.message.reply_text(
@@ -682,7 +1983,7 @@ async def admin_get_category(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
 
     # Сохраняем категорию
-    category = query.data.replace("newcat_", "")
+    category = CATEGORIES[context.args[0]]
     context.user_data['new_product_category'] = category
 
     await query.edit_message_text(
@@ -723,6 +2024,9 @@ async def admin_get_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ADD_PHOTO
 
 async def admin_get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return ConversationHandler.END
+
     photo_id = None
 
     if update.message.photo:
@@ -760,7 +2064,9 @@ async def admin_get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         existing_product.price_per_kg = price
         if photo_id:
             existing_product.photo_id = photo_id
-        existing_product.is_available = True
+        apply_stock_threshold(existing_product)
+        # Старая цена остается в прежней версии, на которую ссылаются уже оформленные заказы
+        ensure_product_version(session, existing_product)
 
         message = f"✅ Товар обновлен:\n{name}\nКоличество добавлено: +{quantity} шт.\nНовая цена: {price} р/кг"
     else:
@@ -771,13 +2077,15 @@ async def admin_get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             quantity=quantity,
             price_per_kg=price,
             photo_id=photo_id,
-            is_available=True
+            is_available=quantity > DEFAULT_LOW_STOCK_THRESHOLD
         )
         session.add(product)
+        ensure_product_version(session, product)
         message = f"✅ Товар добавлен:\n{name} - *{price} р/кг*\nКоличество: {quantity} шт."
 
     session.commit()
     session.close()
+    invalidate_catalog()
 
     # Очищаем контекст
     context.user_data.pop('new_product_name', None)
@@ -795,30 +2103,26 @@ async def admin_get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ========== ФУНКЦИИ АДМИНИСТРАТОРА ДЛЯ УПРАВЛЕНИЯ ЗАКАЗАМИ ==========
 
-async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-
-    if query.from_user.id != ADMIN_ID:
-        return
-
+def build_active_orders_view(with_back=True):
+    """Текст и кнопки списка активных заказов; используется экраном «Заказы» и живой доской"""
     session = Session()
-    orders = session.query(Order).filter(
+    orders = session.query(Order).options(selectinload(Order.items)).filter(
         Order.status.in_(['pending', 'active', 'on_the_way'])
     ).order_by(
         Order.status.desc(),
         Order.created_at.desc()
     ).all()
+    session.close()
+
+    footer = [
+        [InlineKeyboardButton("❌ Отмененные заказы", callback_data=CB_CANCELLED_LIST)],
+        [InlineKeyboardButton("🚚 Доставленные заказы", callback_data=CB_DELIVERED_LIST)]
+    ]
+    if with_back:
+        footer.append([InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_ADMIN)])
 
     if not orders:
-        session.close()
-        keyboard = [
-            [InlineKeyboardButton("❌ Отмененные заказы", callback_data="admin_cancelled")],
-            [InlineKeyboardButton("🚚 Доставленные заказы", callback_data="admin_delivered_list")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]
-        ]
-        await query.edit_message_text("Нет активных заказов.", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+        return "Нет активных заказов.", footer
 
     # Группируем заказы по статусу
     pending_orders = [o for o in orders if o.status == 'pending']
@@ -827,12 +2131,14 @@ async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     text = "📦 *ЗАКАЗЫ*\n\n"
 
-    # Форматируем каждый заказ отдельно
-    for order in pending_orders + active_orders + on_the_way_orders:
-        text += format_order_for_admin(order)
-        text += "\n"
-
-    session.close()
+    # Форматируем каждый заказ отдельно, не выходя за лимит длины сообщения
+    ordered = pending_orders + active_orders + on_the_way_orders
+    for index, order in enumerate(ordered):
+        order_text = format_order_for_admin(order) + "\n"
+        if len(text) + len(order_text) > MAX_MESSAGE_LENGTH - 100:
+            text += f"…и еще {len(ordered) - index} заказов"
+            break
+        text += order_text
 
     # Создаем кнопки управления для каждого заказа
     keyboard = []
@@ -840,41 +2146,45 @@ async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Для ожидающих заказов
     for order in pending_orders:
         keyboard.append([
-            InlineKeyboardButton(f"✅ Подтвердить #{order.id}", callback_data=f"admin_accept_{order.id}")
+            InlineKeyboardButton(f"✅ Подтвердить #{order.id}", callback_data=encode_callback(CB_ACCEPT, order.id))
         ])
         keyboard.append([
-            InlineKeyboardButton(f"❌ Отменить #{order.id}", callback_data=f"admin_cancel_{order.id}")
+            InlineKeyboardButton(f"❌ Отменить #{order.id}", callback_data=encode_callback(CB_CANCEL, order.id))
         ])
         keyboard.append([])  # Пустая строка для разделения
 
     # Для активных заказов
     for order in active_orders:
         keyboard.append([
-            InlineKeyboardButton(f"🚗 Направляюсь #{order.id}", callback_data=f"admin_on_the_way_{order.id}")
+            InlineKeyboardButton(f"🚗 Направляюсь #{order.id}", callback_data=encode_callback(CB_ON_THE_WAY, order.id))
         ])
         keyboard.append([
-            InlineKeyboardButton(f"❌ Отменить #{order.id}", callback_data=f"admin_cancel_{order.id}")
+            InlineKeyboardButton(f"❌ Отменить #{order.id}", callback_data=encode_callback(CB_CANCEL, order.id))
         ])
         keyboard.append([])
 
     # Для заказов "в пути"
     for order in on_the_way_orders:
         keyboard.append([
-            InlineKeyboardButton(f"🎉 Доставлено #{order.id}", callback_data=f"admin_delivered_{order.id}")
+            InlineKeyboardButton(f"🎉 Доставлено #{order.id}", callback_data=encode_callback(CB_DELIVERED, order.id))
         ])
         keyboard.append([])
 
-    keyboard.append([InlineKeyboardButton("❌ Отмененные заказы", callback_data="admin_cancelled")])
-    keyboard.append([InlineKeyboardButton("🚚 Доставленные заказы", callback_data="admin_delivered_list")])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
+    return text, keyboard + footer
+
+async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
 
+    if not is_staff(query.from_user.id):
+        return
+
+    text, keyboard = build_active_orders_view()
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
 def format_order_for_admin(order):
-    """Форматирует информацию о заказе для администратора"""
-    session = Session()
-    order_items = session.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-    session.close()
+    """Форматирует информацию о заказе для администратора (позиции должны быть загружены)"""
+    order_items = order.items
 
     status_emoji = {
         'pending': '⏳',
@@ -897,8 +2207,10 @@ def format_order_for_admin(order):
     text += f"📅 *Дата:* {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
     text += f"📍 *Адрес:* {order.address}\n"
     text += f"📞 *Телефон:* {order.phone}\n"
-    text += f"🕐 *Доставка:* {order.delivery_slot}\n"
+    text += f"🕐 *Доставка:* {format_delivery(order)}\n"
     text += f"📋 *Статус:* {status_text}\n"
+    if order.claimed_by_name:
+        text += f"👷 *Диспетчер:* {order.claimed_by_name}\n"
 
     if order_items:
         text += "🛒 *Товары:*\n"
@@ -908,13 +2220,28 @@ def format_order_for_admin(order):
     text += "─" * 30 + "\n"
     return text
 
+def can_handle_order(user_id, order):
+    """Вести принятый заказ может принявший его диспетчер или администратор"""
+    return is_admin(user_id) or (is_staff(user_id) and order.claimed_by in (None, user_id))
+
 async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    user_id = query.from_user.id
+
+    if not is_staff(user_id):
+        await query.answer()
+        return
 
-    order_id = int(query.data.replace("admin_accept_", ""))
+    order_id = context.args[0]
 
     session = Session()
+    # Заказ закрепляется за первым нажавшим «Подтвердить»
+    claimed = claim_order(session, order_id, user_id, query.from_user.full_name)
+    if claimed:
+        add_order_event(session, order_id, 'accepted')
+    session.commit()
+    if claimed:
+        wake_outbox()
     order = session.query(Order).filter(Order.id == order_id).first()
 
     if not order:
@@ -922,40 +2249,32 @@ async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE)
         session.close()
         return
 
-    # Обновляем статус заказа
-    order.status = 'active'
-    session.commit()
-
-    # Уведомляем пользователя
-    try:
-        user_text = f"✅ *Ваш заказ #{order.id} подтвержден!*\n\n"
-        user_text += f"📍 Адрес: {order.address}\n"
-        user_text += f"📞 Телефон: {order.phone}\n"
-        user_text += f"🕐 Доставка: {order.delivery_slot}\n\n"
-        user_text += "Курьер свяжется с вами перед выездом.\n"
-        user_text += "Спасибо за покупку! 🍅🍉🍒"
-
-        await context.bot.send_message(
-            chat_id=order.user_id,
-            text=user_text,
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления пользователю: {e}")
+    if not claimed:
+        session.close()
+        if order.claimed_by and order.claimed_by != user_id:
+            await query.answer(f"Заказ уже принял {order.claimed_by_name}.", show_alert=True)
+        else:
+            await query.answer("Заказ уже обработан.", show_alert=True)
+        await admin_orders(update, context)
+        return
 
     session.close()
+    await close_order_notifications(context.bot, order_id, user_id, f"👷 Принял: {query.from_user.full_name}")
 
-    await query.answer("Заказ подтвержден!", show_alert=True)
+    await query.answer("Заказ подтвержден и закреплен за вами!", show_alert=True)
 
-    # Обновляем сообщение с заказами
-    await admin_orders(update, context)
+    # Обновляем доски и сообщение с заказами
+    await refresh_after_status_change(update, context)
 
 async def admin_on_the_way(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Направляюсь'"""
     query = update.callback_query
-    await query.answer()
 
-    order_id = int(query.data.replace("admin_on_the_way_", ""))
+    if not is_staff(query.from_user.id):
+        await query.answer()
+        return
+
+    order_id = context.args[0]
 
     session = Session()
     order = session.query(Order).filter(Order.id == order_id).first()
@@ -965,85 +2284,198 @@ async def admin_on_the_way(update: Update, context: ContextTypes.DEFAULT_TYPE):
         session.close()
         return
 
-    # Обновляем статус заказа
-    order.status = 'on_the_way'
-    order.on_the_way_at = datetime.now()
-    session.commit()
-
-    # Уведомляем пользователя
-    try:
-        user_text = f"🚗 *Курьер направляется к вам!*\n\n"
-        user_text += f"📦 Заказ #{order.id}\n"
-        user_text += f"📍 Адрес: {order.address}\n"
-        user_text += f"📞 Телефон курьера: +7 (XXX) XXX-XX-XX\n\n"
-        user_text += "⏳ *Ожидайте курьера в течение 10-15 минут!*\n\n"
-        user_text += "Спасибо за терпение! 🍅🍉🍒"
-
-        await context.bot.send_message(
-            chat_id=order.user_id,
-            text=user_text,
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления пользователю: {e}")
+    if not can_handle_order(query.from_user.id, order):
+        await query.answer(f"Заказ ведет {order.claimed_by_name}.", show_alert=True)
+        session.close()
+        return
 
+    # Обновляем статус заказа, только если он все еще подтвержден
+    if not set_order_status(session, order.id, ('active',), 'on_the_way', on_the_way_at=datetime.now()):
+        session.close()
+        await query.answer("Заказ уже обработан.", show_alert=True)
+        await refresh_after_status_change(update, context)
+        return
+    add_order_event(session, order.id, 'on_the_way')
+    session.commit()
     session.close()
+    wake_outbox()
 
     await query.answer("Клиент уведомлен, что курьер направляется!", show_alert=True)
 
-    # Обновляем сообщение с заказами
-    await admin_orders(update, context)
+    # Обновляем доски и сообщение с заказами
+    await refresh_after_status_change(update, context)
 
 async def admin_mark_delivered(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик кнопки 'Доставлено'"""
+    """Обработчик кнопки 'Доставлено': запрашивает фактический вес позиций"""
     query = update.callback_query
-    await query.answer()
+    user_id = query.from_user.id
 
-    order_id = int(query.data.replace("admin_delivered_", ""))
+    if not is_staff(user_id):
+        await query.answer()
+        return ConversationHandler.END
+
+    order_id = context.args[0]
 
     session = Session()
-    order = session.query(Order).filter(Order.id == order_id).first()
+    order = session.query(Order).options(selectinload(Order.items)).filter(Order.id == order_id).first()
+    session.close()
 
     if not order:
         await query.answer("Заказ не найден!", show_alert=True)
-        session.close()
-        return
+        return ConversationHandler.END
 
-    # Обновляем статус заказа
-    order.status = 'delivered'
-    order.delivered_at = datetime.now()
-    session.commit()
+    if not can_handle_order(user_id, order):
+        await query.answer(f"Заказ ведет {order.claimed_by_name}.", show_alert=True)
+        return ConversationHandler.END
+
+    if order.status != 'on_the_way':
+        await query.answer("Доставку можно отметить только у заказа в пути.", show_alert=True)
+        return ConversationHandler.END
 
-    # Уведомляем пользователя
+    await query.answer()
+    context.user_data['deliver_order_id'] = order.id
+
+    text = f"⚖️ Заказ #{order.id}: введите фактический вес позиций в кг одним сообщением, через пробел или по строке, в порядке списка:\n\n"
+    for number, item in enumerate(order.items, 1):
+        text += f"{number}. {item.product_name} x{item.quantity} шт. — {item.price_per_kg} р/кг\n"
+    text += "\nНапример: " + " ".join(["1.2"] * len(order.items)) + "\nОтмена: /cancel"
+    await query.edit_message_text(text)
+    return ADMIN_DELIVERY_WEIGHTS
+
+def parse_weights(text, count):
+    """Список из count весов в кг (десятичный разделитель — точка или запятая); None при ошибке"""
+    parts = [part for part in re.split(r"[\s;]+", text.strip()) if part]
+    if len(parts) != count:
+        return None
     try:
-        user_text = f"🎉 *Ваш заказ доставлен успешно!*\n\n"
-        user_text += f"📦 Заказ #{order.id}\n"
-        user_text += f"📍 Адрес: {order.address}\n"
-        user_text += f"🕐 Время доставки: {order.delivered_at.strftime('%H:%M')}\n\n"
-        user_text += "🙏 *Спасибо за покупку!*\n\n"
-        user_text += "Надеемся, вам понравились наши свежие овощи и фрукты! 🍅🍉🍒\n"
-        user_text += "Ждем вас снова! 💚"
+        weights = [float(part.replace(',', '.')) for part in parts]
+    except ValueError:
+        return None
+    # nan и inf проходят сравнения и испортили бы суммы заказа и дневную выручку
+    if any(not math.isfinite(weight) or weight < 0 or weight > 1000 for weight in weights):
+        return None
+    return weights
 
-        await context.bot.send_message(
-            chat_id=order.user_id,
-            text=user_text,
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления пользователю: {e}")
+async def admin_finish_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Принимает веса, считает суммы, закрывает заказ и отправляет накладную"""
+    order_id = context.user_data.get('deliver_order_id')
+    admin_id = update.effective_user.id
+
+    if not order_id:
+        await update.message.reply_text("Ошибка: не найден ID заказа", reply_markup=get_panel_keyboard(admin_id))
+        return ConversationHandler.END
 
+    session = Session()
+    order = session.query(Order).options(selectinload(Order.items)).filter(Order.id == order_id).first()
+
+    if not order:
+        session.close()
+        await update.message.reply_text("Заказ не найден", reply_markup=get_panel_keyboard(admin_id))
+        return ConversationHandler.END
+
+    # Пока курьер вводил вес, заказ могли отменить или передать другому
+    if order.status != 'on_the_way' or not can_handle_order(admin_id, order):
+        session.close()
+        context.user_data.pop('deliver_order_id', None)
+        await update.message.reply_text(f"Заказ #{order_id} уже не в пути у вас — доставка не отмечена.", reply_markup=get_panel_keyboard(admin_id))
+        return ConversationHandler.END
+
+    weights = parse_weights(update.message.text, len(order.items))
+    if weights is None:
+        session.close()
+        await update.message.reply_text(
+            f"Нужно {len(order.items)} чисел — вес каждой позиции в кг, например: 1.2 0,8\nОтмена: /cancel"
+        )
+        return ADMIN_DELIVERY_WEIGHTS
+
+    for item, weight in zip(order.items, weights):
+        item.weight_kg = weight
+        item.amount = round(weight * (item.price_per_kg or 0), 2)
+    total_weight_kg = round(sum(weights), 3)
+    total_amount = round(sum(item.amount for item in order.items), 2)
+    delivered_at = datetime.now()
+    # Статус меняется условным UPDATE: параллельная отмена или повторная отметка не пройдут
+    if not set_order_status(
+        session, order.id, ('on_the_way',), 'delivered',
+        delivered_at=delivered_at, total_weight_kg=total_weight_kg, total_amount=total_amount
+    ):
+        session.rollback()
+        session.close()
+        context.user_data.pop('deliver_order_id', None)
+        await update.message.reply_text(f"Заказ #{order_id} уже не в пути — доставка не отмечена.", reply_markup=get_panel_keyboard(admin_id))
+        return ConversationHandler.END
+    session.refresh(order)
+    record_order_stats(session, order, 'delivered', order.items, delivered_at)
+    add_order_event(session, order.id, 'delivered', at=delivered_at.strftime('%H:%M'))
+    session.commit()
+    invoice = render_invoice(order)
+    total_amount = order.total_amount
     session.close()
+    wake_outbox()
+    context.user_data.pop('deliver_order_id', None)
+
+    await update.message.reply_document(
+        document=invoice,
+        filename=f"invoice_{order_id}.html",
+        caption=f"✅ Заказ #{order_id} доставлен. Итого: {total_amount:.2f} р",
+        reply_markup=get_panel_keyboard(admin_id)
+    )
 
-    await query.answer("Заказ отмечен как доставленный!", show_alert=True)
+    # Обновляем доски и сообщение с заказами
+    await refresh_after_status_change(update, context)
+    return ConversationHandler.END
 
-    # Обновляем сообщение с заказами
-    await admin_orders(update, context)
+def render_invoice(order):
+    """Накладная заказа по фактическому весу в виде HTML-документа"""
+    rows = ""
+    for number, item in enumerate(order.items, 1):
+        rows += (
+            f"<tr><td>{number}</td><td>{html.escape(item.product_name or '')}</td><td>{item.quantity}</td>"
+            f"<td>{item.weight_kg or 0:.3f}</td><td>{item.price_per_kg or 0:.2f}</td><td>{item.amount or 0:.2f}</td></tr>\n"
+        )
+    delivered_at = order.delivered_at.strftime('%d.%m.%Y %H:%M') if order.delivered_at else ''
+    document = f"""<!DOCTYPE html>
+<html lang="ru">
+<head><meta charset="utf-8"><title>Накладная к заказу #{order.id}</title>
+<style>body{{font-family:sans-serif}} table{{border-collapse:collapse}} td,th{{border:1px solid #999;padding:4px 8px}}</style>
+</head>
+<body>
+<h2>Накладная к заказу #{order.id}</h2>
+<p>Покупатель: {html.escape(order.user_name or '')}, тел. {html.escape(order.phone or '')}<br>
+Адрес: {html.escape(order.address or '')}<br>
+Доставлен: {delivered_at}</p>
+<table>
+<tr><th>№</th><th>Товар</th><th>Шт.</th><th>Вес, кг</th><th>Цена, р/кг</th><th>Сумма, р</th></tr>
+{rows}<tr><th colspan="3">Итого</th><th>{order.total_weight_kg or 0:.3f}</th><th></th><th>{order.total_amount or 0:.2f}</th></tr>
+</table>
+</body>
+</html>
+"""
+    return document.encode('utf-8')
 
 async def admin_start_cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    user_id = query.from_user.id
+
+    if not is_staff(user_id):
+        await query.answer()
+        return ConversationHandler.END
+
+    order_id = context.args[0]
+
+    session = Session()
+    order = session.query(Order).filter(Order.id == order_id).first()
+    session.close()
 
-    order_id = int(query.data.replace("admin_cancel_", ""))
+    if order and not can_handle_order(user_id, order):
+        await query.answer(f"Заказ ведет {order.claimed_by_name}.", show_alert=True)
+        return ConversationHandler.END
+
+    if order and order.status not in ('pending', 'active'):
+        await query.answer("Заказ уже отправлен, доставлен или отменен.", show_alert=True)
+        return ConversationHandler.END
+
+    await query.answer()
     context.user_data['cancel_order_id'] = order_id
 
     await query.edit_message_text("📝 Введите причину отмены заказа:")
@@ -1053,70 +2485,65 @@ async def admin_finish_cancel_order(update: Update, context: ContextTypes.DEFAUL
     reason = update.message.text
     order_id = context.user_data.get('cancel_order_id')
 
+    admin_id = update.effective_user.id
+
     if not order_id:
-        await update.message.reply_text("Ошибка: не найден ID заказа", reply_markup=get_admin_keyboard())
+        await update.message.reply_text("Ошибка: не найден ID заказа", reply_markup=get_panel_keyboard(admin_id))
         return ConversationHandler.END
 
     session = Session()
     order = session.query(Order).filter(Order.id == order_id).first()
 
     if not order:
-        await update.message.reply_text("Заказ не найден", reply_markup=get_admin_keyboard())
+        await update.message.reply_text("Заказ не найден", reply_markup=get_panel_keyboard(admin_id))
         session.close()
         return ConversationHandler.END
 
-    user_id = order.user_id
-    old_status = order.status
-
-    order.status = 'cancelled'
-    order.cancel_reason = reason
-    order.cancelled_at = datetime.now()
-
-    # Если заказ был активен, возвращаем товары на склад
-    if old_status in ['active', 'on_the_way']:
-        for item in order.items:
-            product = session.query(Product).filter(Product.id == item.product_id).first()
-            if product:
-                product.quantity += item.quantity
+    # Отменить можно только еще не отправленный заказ; повторная отмена не пройдет
+    cancelled_at = datetime.now()
+    if not set_order_status(session, order.id, ('pending', 'active'), 'cancelled', cancel_reason=reason, cancelled_at=cancelled_at):
+        session.close()
+        context.user_data.pop('cancel_order_id', None)
+        await update.message.reply_text(
+            f"Заказ #{order_id} уже отправлен, доставлен или отменен.",
+            reply_markup=get_panel_keyboard(admin_id)
+        )
+        return ConversationHandler.END
+    record_order_stats(session, order, 'cancelled', order.items, cancelled_at)
+    add_order_event(session, order.id, 'cancelled', reason=reason, at=cancelled_at.strftime('%d.%m.%Y %H:%M'))
+    if order.slot_instance_id:
+        release_slot(session, order.slot_instance_id)
+    # Товар списан при оформлении — возвращаем его на склад; старые заказы склад не трогали
+    stock_changes = change_stock(session, sum_item_quantities(order.items, 1)) if order.stock_written_off else []
 
     session.commit()
     session.close()
-
-    try:
-        user_text = f"❌ *Ваш заказ #{order_id} отменен*\n\n"
-        user_text += f"📝 *Причина отмены:* {reason}\n"
-        user_text += f"🕐 *Время отмены:* {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-        user_text += "Если у вас есть вопросы, свяжитесь с нами."
-
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=user_text,
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления пользователю: {e}")
+    wake_outbox()
+    invalidate_slot_availability()
+    after_stock_change(context.bot, stock_changes)
+    await close_order_notifications(context.bot, order_id, admin_id, "❌ Заказ отменен")
 
     await update.message.reply_text(
         f"✅ Заказ #{order_id} отменен. Пользователь уведомлен.",
-        reply_markup=get_admin_keyboard()
+        reply_markup=get_panel_keyboard(admin_id)
     )
 
-    await admin_orders(update, context)
+    await refresh_after_status_change(update, context)
     return ConversationHandler.END
 
 async def admin_cancelled_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    if query.from_user.id != ADMIN_ID:
+    if not is_staff(query.from_user.id):
         return
 
-    session = Session()
+    session = ReadSession('orders')
     cancelled_orders = session.query(Order).filter(Order.status == 'cancelled').order_by(Order.cancelled_at.desc()).limit(10).all()
 
     if not cancelled_orders:
         session.close()
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_orders")]]
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data=CB_ADMIN_ORDERS)]]
         await query.edit_message_text("Нет отмененных заказов.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
@@ -1133,8 +2560,8 @@ async def admin_cancelled_orders(update: Update, context: ContextTypes.DEFAULT_T
     session.close()
 
     keyboard = [
-        [InlineKeyboardButton("📋 Активные заказы", callback_data="admin_orders")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]
+        [InlineKeyboardButton("📋 Активные заказы", callback_data=CB_ADMIN_ORDERS)],
+        [InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_ADMIN)]
     ]
 
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
@@ -1143,15 +2570,15 @@ async def admin_delivered_list(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
 
-    if query.from_user.id != ADMIN_ID:
+    if not is_staff(query.from_user.id):
         return
 
-    session = Session()
+    session = ReadSession('orders')
     delivered_orders = session.query(Order).filter(Order.status == 'delivered').order_by(Order.delivered_at.desc()).limit(10).all()
 
     if not delivered_orders:
         session.close()
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_orders")]]
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data=CB_ADMIN_ORDERS)]]
         await query.edit_message_text("Нет доставленных заказов.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
@@ -1161,14 +2588,16 @@ async def admin_delivered_list(update: Update, context: ContextTypes.DEFAULT_TYP
         text += f"👤 {order.user_name}\n"
         text += f"📅 Создан: {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
         text += f"✅ Доставлен: {order.delivered_at.strftime('%d.%m.%Y %H:%M')}\n"
+        if order.total_amount is not None:
+            text += f"💰 Итого: {order.total_amount:.2f} р ({order.total_weight_kg:.3f} кг)\n"
         text += f"📍 Адрес: {order.address}\n"
         text += "─" * 30 + "\n\n"
 
     session.close()
 
     keyboard = [
-        [InlineKeyboardButton("📋 Активные заказы", callback_data="admin_orders")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_admin")]
+        [InlineKeyboardButton("📋 Активные заказы", callback_data=CB_ADMIN_ORDERS)],
+        [InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_ADMIN)]
     ]
 
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
@@ -1177,65 +2606,826 @@ async def admin_slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    if query.from_user.id != ADMIN_ID:
+    if not is_admin(query.from_user.id):
         return
 
+    today = datetime.now().date()
     session = Session()
     slots = session.query(DeliverySlot).order_by(DeliverySlot.start_hour).all()
+    booked_today = dict(session.query(SlotInstance.slot_id, SlotInstance.booked).filter(SlotInstance.day == today).all())
     session.close()
 
     keyboard = []
     for slot in slots:
         status = "✅" if slot.is_active else "❌"
-        keyboard.append([InlineKeyboardButton(f"{status} {slot.start_hour}:00 - {slot.end_hour}:00", callback_data=f"toggleslot_{slot.id}")])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_admin")])
+        booked = booked_today.get(slot.id, 0)
+        keyboard.append([InlineKeyboardButton(
+            f"{status} {slot.start_hour}:00 - {slot.end_hour}:00 ({booked}/{slot.capacity})",
+            callback_data=encode_callback(CB_TOGGLE_SLOT, slot.id)
+        )])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_ADMIN)])
+
+    await query.edit_message_text(
+        "Слоты доставки (нажмите для переключения):\n"
+        "В скобках — занято/вместимость на сегодня.\n"
+        "Изменить вместимость: /capacity ЧАС КОЛИЧЕСТВО",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def admin_slot_capacity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/capacity ЧАС КОЛИЧЕСТВО — вместимость слота, начинающегося в указанный час"""
+    if not is_admin(update.effective_user.id):
+        return
+
+    try:
+        start_hour = int(context.args[0])
+        capacity = int(context.args[1])
+        if capacity < 0:
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /capacity ЧАС КОЛИЧЕСТВО\nНапример: /capacity 14 8")
+        return
+
+    session = Session()
+    slot = session.query(DeliverySlot).filter(DeliverySlot.start_hour == start_hour).first()
+    if not slot:
+        session.close()
+        await update.message.reply_text(f"Слот, начинающийся в {start_hour}:00, не найден.")
+        return
+
+    slot.capacity = capacity
+    # Новая вместимость действует и на уже открытые даты, начиная с сегодняшней
+    session.query(SlotInstance).filter(
+        SlotInstance.slot_id == slot.id,
+        SlotInstance.day >= datetime.now().date()
+    ).update({SlotInstance.capacity: capacity}, synchronize_session=False)
+    session.commit()
+    session.close()
+    invalidate_slot_availability()
 
-    await query.edit_message_text("Слоты доставки (нажмите для переключения):", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text(
+        f"✅ Вместимость слота {start_hour}:00 - {start_hour + 1}:00: {capacity} заказов.",
+        reply_markup=get_admin_keyboard()
+    )
+
+async def admin_stock_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/threshold НАЗВАНИЕ КОЛИЧЕСТВО — порог остатка, при котором товар скрывается из каталога"""
+    if not is_admin(update.effective_user.id):
+        return
+
+    try:
+        name = " ".join(context.args[:-1])
+        threshold = int(context.args[-1])
+        if not name or threshold < 0:
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /threshold НАЗВАНИЕ КОЛИЧЕСТВО\nНапример: /threshold Яблоки 3")
+        return
+
+    session = Session()
+    products = session.query(Product).filter(Product.name.ilike(name)).all()
+    if not products:
+        session.close()
+        await update.message.reply_text(f"Товар «{name}» не найден.")
+        return
+
+    lines = []
+    for product in products:
+        product.low_stock_threshold = threshold
+        apply_stock_threshold(product)
+        state = "в каталоге" if product.is_available else "скрыт"
+        lines.append(f"{product.name} ({product.category}): остаток {product.quantity} шт., {state}")
+    session.commit()
+    session.close()
+    invalidate_catalog()
+
+    await update.message.reply_text(
+        f"✅ Порог остатка {threshold} шт.:\n" + "\n".join(lines),
+        reply_markup=get_admin_keyboard()
+    )
 
 async def toggle_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    slot_id = int(query.data.replace("toggleslot_", ""))
+    if not is_admin(query.from_user.id):
+        return
+
+    slot_id = context.args[0]
 
     session = Session()
     slot = session.query(DeliverySlot).filter(DeliverySlot.id == slot_id).first()
     slot.is_active = not slot.is_active
     session.commit()
     session.close()
+    invalidate_slot_availability()
 
     await admin_slots(update, context)
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# ========== ОЧЕРЕДЬ УВЕДОМЛЕНИЙ (OUTBOX) ==========
+
+def build_user_notification(event_type, order, data):
+    """Текст уведомления клиенту о событии заказа (None — клиента не уведомляем)"""
+    if event_type == 'accepted':
+        user_text = f"✅ *Ваш заказ #{order.id} подтвержден!*\n\n"
+        user_text += f"📍 Адрес: {order.address}\n"
+        user_text += f"📞 Телефон: {order.phone}\n"
+        user_text += f"🕐 Доставка: {format_delivery(order)}\n\n"
+        user_text += "Курьер свяжется с вами перед выездом.\n"
+        user_text += "Спасибо за покупку! 🍅🍉🍒"
+        return user_text
+
+    if event_type == 'on_the_way':
+        user_text = f"🚗 *Курьер направляется к вам!*\n\n"
+        user_text += f"📦 Заказ #{order.id}\n"
+        user_text += f"📍 Адрес: {order.address}\n"
+        user_text += f"📞 Телефон курьера: +7 (XXX) XXX-XX-XX\n\n"
+        user_text += "⏳ *Ожидайте курьера в течение 10-15 минут!*\n\n"
+        user_text += "Спасибо за терпение! 🍅🍉🍒"
+        return user_text
+
+    if event_type == 'delivered':
+        user_text = f"🎉 *Ваш заказ доставлен успешно!*\n\n"
+        user_text += f"📦 Заказ #{order.id}\n"
+        user_text += f"📍 Адрес: {order.address}\n"
+        user_text += f"🕐 Время доставки: {data.get('at')}\n"
+        if order.total_amount is not None:
+            user_text += f"⚖️ Вес: {order.total_weight_kg:.3f} кг\n"
+            user_text += f"💰 *Итого: {order.total_amount:.2f} р*\n"
+        user_text += "\n🙏 *Спасибо за покупку!*\n\n"
+        user_text += "Надеемся, вам понравились наши свежие овощи и фрукты! 🍅🍉🍒\n"
+        user_text += "Ждем вас снова! 💚"
+        return user_text
+
+    if event_type == 'cancelled':
+        user_text = f"❌ *Ваш заказ #{order.id} отменен*\n\n"
+        user_text += f"📝 *Причина отмены:* {data.get('reason')}\n"
+        user_text += f"🕐 *Время отмены:* {data.get('at')}\n\n"
+        user_text += "Если у вас есть вопросы, свяжитесь с нами."
+        return user_text
+
+    return None
+
+async def deliver_order_event(bot, event, order):
+    if event.event_type == 'created':
+        # Заказ могли уже принять или отменить, пока событие ждало в очереди
+        if order.status == 'pending':
+            await send_order_notification_to_admin(bot, order)
+        return
+
+    user_text = build_user_notification(event.event_type, order, event.data)
+    if not user_text:
+        return
+    if event.event_type == 'delivered' and order.total_amount is not None:
+        # Накладная уходит одним сообщением с текстом уведомления в подписи
+        async with notify_limiter:
+            await bot.send_document(
+                chat_id=order.user_id,
+                document=render_invoice(order),
+                filename=f"invoice_{order.id}.html",
+                caption=user_text,
+                parse_mode='Markdown'
+            )
+        return
+    await send_limited(bot, order.user_id, text=user_text, parse_mode='Markdown')
+
+def wake_outbox():
+    """Будит диспетчер outbox сразу после коммита нового события"""
+    if outbox_state['wakeup'] is not None:
+        outbox_state['wakeup'].set()
+
+def is_transient_telegram_error(error):
+    return isinstance(error, RetryAfter) or (isinstance(error, NetworkError) and not isinstance(error, BadRequest))
+
+def outbox_retry_delay(event, error, now):
+    """Экспоненциальная пауза: каждая следующая примерно равна возрасту события"""
+    age = (now - event.created_at).total_seconds() if event.created_at else 0
+    delay = min(OUTBOX_MAX_BACKOFF, max(OUTBOX_POLL_INTERVAL, age))
+    if isinstance(error, RetryAfter):
+        retry_after = error.retry_after
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        delay = max(delay, retry_after)
+    return delay
+
+def claim_outbox_batch():
+    """Забирает пачку необработанных событий короткой транзакцией; возвращает (события, {id: заказ}).
+
+    Строки выбираются с SKIP LOCKED и сразу откладываются на OUTBOX_CLAIM_TIMEOUT,
+    поэтому несколько реплик бота разбирают очередь, не мешая друг другу,
+    а отправка в Telegram идет без открытой транзакции.
+    """
+    session = Session(expire_on_commit=False)
+    try:
+        now = datetime.now()
+        # Пока событие заказа ждет повтора (или отправляется), следующие события того же заказа тоже ждут
+        waiting_orders = session.query(OrderEvent.order_id).filter(
+            OrderEvent.processed_at.is_(None),
+            OrderEvent.next_attempt_at > now
+        )
+        events = session.query(OrderEvent).filter(
+            OrderEvent.processed_at.is_(None),
+            ~OrderEvent.order_id.in_(waiting_orders)
+        ).order_by(OrderEvent.id).limit(OUTBOX_BATCH_SIZE).with_for_update(skip_locked=True).all()
+        if not events:
+            return [], {}
+
+        for event in events:
+            event.next_attempt_at = now + timedelta(seconds=OUTBOX_CLAIM_TIMEOUT)
+        orders = {
+            order.id: order
+            for order in session.query(Order).options(selectinload(Order.items)).filter(
+                Order.id.in_({event.order_id for event in events})
+            )
+        }
+        session.commit()
+        return events, orders
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def outbox_result_values(event, result, now):
+    """Поля события после попытки отправки: result — None при успехе или исключение"""
+    if result is None:
+        return {'processed_at': now, 'next_attempt_at': None}
+    values = {'last_error': str(result), 'next_attempt_at': None}
+    # Заблокировавшему бота пользователю повторять бессмысленно
+    if isinstance(result, Forbidden):
+        values['processed_at'] = now
+        logger.error("Событие #%s (%s) заказа #%s не доставлено: %s", event.id, event.event_type, event.order_id, result)
+        return values
+    # Сбои сети и RetryAfter не тратят попытки: событие ждет, пока Telegram снова доступен.
+    # BadRequest в PTB — тоже NetworkError, но это постоянная ошибка (разметка, chat not found)
+    if not is_transient_telegram_error(result):
+        values['attempts'] = event.attempts + 1
+        if values['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            values['processed_at'] = now
+            logger.error("Событие #%s (%s) заказа #%s не доставлено: %s", event.id, event.event_type, event.order_id, result)
+            return values
+    values['next_attempt_at'] = now + timedelta(seconds=outbox_retry_delay(event, result, now))
+    return values
+
+def save_outbox_results(events, results):
+    """Записывает итоги отправки отдельной короткой транзакцией, в которой нет чтения перед записью.
+
+    Не дошедшие до отправки события (их заказ остановился на ошибке) снова доступны диспетчеру.
+    """
+    now = datetime.now()
+    session = Session()
+    try:
+        for event in events:
+            if event.id in results:
+                values = outbox_result_values(event, results[event.id], now)
+            else:
+                values = {'next_attempt_at': None}
+            session.query(OrderEvent).filter(OrderEvent.id == event.id).update(values, synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+async def dispatch_outbox_batch(bot):
+    """Отправляет одну пачку необработанных событий; возвращает их количество"""
+    events, orders = await asyncio.to_thread(run_db, claim_outbox_batch)
+    if not events:
+        return 0
+
+    # Получив уведомление, пользователь увидит новый статус и в «Моих заказах», даже если реплика отстает
+    mark_written('orders')
+    for order in orders.values():
+        mark_written(order.user_id)
+
+    # События одного заказа отправляются по порядку, разные заказы — параллельно
+    by_order = {}
+    for event in events:
+        by_order.setdefault(event.order_id, []).append(event)
+    results = {}
+
+    async def deliver_in_order(order_events):
+        for event in order_events:
+            try:
+                await deliver_order_event(bot, event, orders[event.order_id])
+                results[event.id] = None
+            except Exception as e:
+                results[event.id] = e
+                # Следующие события заказа не обгоняют неотправленное
+                break
+
+    await asyncio.gather(*(deliver_in_order(order_events) for order_events in by_order.values()))
+
+    await asyncio.to_thread(run_db, save_outbox_results, events, results)
+    return len(events)
+
+async def run_outbox_dispatcher(application):
+    """Фоновый цикл: разбирает outbox пачками, просыпаясь по событию или по таймеру"""
+    outbox_state['wakeup'] = asyncio.Event()
+    while True:
+        try:
+            processed = await dispatch_outbox_batch(application.bot)
+        except Exception as e:
+            logger.error("Ошибка диспетчера уведомлений: %s", e)
+            processed = 0
+
+        if processed >= OUTBOX_BATCH_SIZE:
+            continue
+        try:
+            await asyncio.wait_for(outbox_state['wakeup'].wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        outbox_state['wakeup'].clear()
+
+# ========== ЖИВАЯ ДОСКА ЗАКАЗОВ ==========
+
+def get_boards():
+    """Доски сотрудников {user_id: (chat_id, message_id)}; читаются из БД один раз"""
+    if board_state['boards'] is None:
+        session = Session()
+        board_state['boards'] = {
+            board.user_id: (board.chat_id, board.message_id)
+            for board in session.query(AdminBoard).all()
+        }
+        session.close()
+    return board_state['boards']
+
+def drop_board(user_id):
+    get_boards().pop(user_id, None)
+    board_state['sent'].pop(user_id, None)
+    session = Session()
+    session.query(AdminBoard).filter(AdminBoard.user_id == user_id).delete()
+    session.commit()
+    session.close()
+
+def request_board_refresh(application):
+    """Помечает доски устаревшими; обновление выполнится не чаще BOARD_REFRESH_INTERVAL"""
+    board_state['dirty'] = True
+    if not get_boards():
+        return
+    task = board_state['task']
+    if task is None or task.done():
+        board_state['task'] = application.create_task(refresh_boards(application.bot))
+
+async def refresh_boards(bot):
+    while board_state['dirty']:
+        delay = board_state['last_refresh'] + BOARD_REFRESH_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        board_state['dirty'] = False
+        board_state['last_refresh'] = time.monotonic()
+
+        text, keyboard = build_active_orders_view(with_back=False)
+        text += f"\n🔄 Обновлено: {datetime.now().strftime('%H:%M:%S')}"
+        # Сравниваем без строки времени: редактируем только доски, содержимое которых изменилось
+        digest = hash((text.rsplit("\n", 1)[0], repr(keyboard)))
+
+        boards = [
+            (user_id, chat_id, message_id)
+            for user_id, (chat_id, message_id) in list(get_boards().items())
+            if board_state['sent'].get(user_id) != digest
+        ]
+        results = await asyncio.gather(
+            *(edit_board(bot, chat_id, message_id, text, keyboard) for _, chat_id, message_id in boards),
+            return_exceptions=True
+        )
+        for (user_id, _, _), result in zip(boards, results):
+            if result is True:
+                board_state['sent'][user_id] = digest
+            elif isinstance(result, BadRequest) and "not found" in str(result).lower():
+                # Доску удалили в чате — больше ее не обновляем
+                drop_board(user_id)
+            elif isinstance(result, Exception):
+                logger.error("Ошибка при обновлении доски заказов %s: %s", user_id, result)
+
+async def edit_board(bot, chat_id, message_id, text, keyboard):
+    try:
+        async with notify_limiter:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return True
+
+async def admin_board_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/board — закрепить в чате доску активных заказов, которая обновляется сама"""
     user_id = update.effective_user.id
+    if not is_staff(user_id):
+        return
 
-    with cache_lock:
-        keys_to_remove = []
-        for key, lock_info in product_lock_cache.items():
-            if lock_info['user_id'] == user_id:
-                keys_to_remove.append(key)
+    text, keyboard = build_active_orders_view(with_back=False)
+    message = await update.message.reply_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+    try:
+        await message.pin(disable_notification=True)
+    except BadRequest as e:
+        logger.warning("Не удалось закрепить доску заказов: %s", e)
 
-        for key in keys_to_remove:
-            del product_lock_cache[key]
-            if key in lock_cache_expiry:
-                del lock_cache_expiry[key]
+    session = Session()
+    board = session.query(AdminBoard).filter(AdminBoard.user_id == user_id).first()
+    if not board:
+        board = AdminBoard(user_id=user_id)
+        session.add(board)
+    board.chat_id = message.chat_id
+    board.message_id = message.message_id
+    session.commit()
+    session.close()
+
+    get_boards()[user_id] = (message.chat_id, message.message_id)
+    board_state['sent'].pop(user_id, None)
+
+async def refresh_after_status_change(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """После смены статуса: доски обновятся сами; без доски перерисовываем список заказов"""
+    request_board_refresh(context.application)
+    if update.callback_query and update.effective_user.id not in get_boards():
+        await admin_orders(update, context)
+
+# ========== СОТРУДНИКИ ==========
+
+async def admin_staff_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/staff — список сотрудников; /staff add ID admin|courier [имя]; /staff remove ID"""
+    if not is_admin(update.effective_user.id):
+        return
+
+    args = context.args or []
+    session = Session()
+
+    if len(args) >= 3 and args[0] == "add" and args[2] in (ROLE_ADMIN, ROLE_COURIER):
+        try:
+            staff_id = int(args[1])
+        except ValueError:
+            session.close()
+            await update.message.reply_text("ID сотрудника должен быть числом.")
+            return
+        member = session.query(StaffMember).filter(StaffMember.user_id == staff_id).first()
+        if not member:
+            member = StaffMember(user_id=staff_id)
+            session.add(member)
+        member.role = args[2]
+        member.name = " ".join(args[3:]) or member.name
+        session.commit()
+        text = f"✅ Сотрудник {staff_id} добавлен с ролью {args[2]}."
+    elif len(args) == 2 and args[0] == "remove":
+        try:
+            staff_id = int(args[1])
+        except ValueError:
+            session.close()
+            await update.message.reply_text("ID сотрудника должен быть числом.")
+            return
+        session.query(StaffMember).filter(StaffMember.user_id == staff_id).delete()
+        session.commit()
+        text = f"✅ Сотрудник {staff_id} удален."
+        if staff_id in ENV_ADMIN_IDS or staff_id in ENV_COURIER_IDS:
+            text += "\n⚠️ Он указан в переменных окружения и сохранит доступ."
+    else:
+        members = session.query(StaffMember).order_by(StaffMember.role, StaffMember.user_id).all()
+        text = "👥 Сотрудники:\n\n"
+        for user_id in sorted(ENV_ADMIN_IDS):
+            text += f"• {user_id} — admin (окружение)\n"
+        for user_id in sorted(ENV_COURIER_IDS - ENV_ADMIN_IDS):
+            text += f"• {user_id} — courier (окружение)\n"
+        for member in members:
+            text += f"• {member.user_id} — {member.role}" + (f" ({member.name})" if member.name else "") + "\n"
+        text += "\nДобавить: /staff add ID admin|courier [имя]\nУдалить: /staff remove ID"
+
+    session.close()
+    await asyncio.to_thread(refresh_permissions)
+    await update.message.reply_text(text)
+
+# ========== ВЫГРУЗКА ЗАКАЗОВ ДЛЯ БУХГАЛТЕРИИ ==========
+
+EXPORT_COLUMNS = [
+    "order_id", "created_at", "status", "user_id", "user_name", "phone", "address",
+    "delivery_date", "delivery_slot", "delivered_at", "cancelled_at", "cancel_reason",
+    "total_weight_kg", "total_amount",
+    "product_id", "product_name", "quantity", "price_per_kg", "weight_kg", "amount"
+]
+
+def format_csv_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%d.%m.%Y %H:%M')
+    if isinstance(value, date):
+        return value.strftime('%d.%m.%Y')
+    return value
+
+def write_orders_csv(fileobj, date_from, date_to):
+    """Потоково пишет заказы и их позиции за период [date_from, date_to) в CSV.
+
+    Строки читаются серверным курсором пачками по EXPORT_BATCH_SIZE,
+    поэтому расход памяти не зависит от размера периода.
+    Возвращает количество записанных строк.
+    """
+    writer = csv.writer(fileobj, delimiter=';')
+    writer.writerow(EXPORT_COLUMNS)
+
+    # Заказы периода могут лежать и в рабочих таблицах, и в архиве
+    parts = []
+    for order_model, item_model in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)):
+        parts.append(select(
+            order_model.id.label('order_id'), order_model.created_at, order_model.status, order_model.user_id, order_model.user_name,
+            order_model.phone, order_model.address, order_model.delivery_date, order_model.delivery_slot, order_model.delivered_at,
+            order_model.cancelled_at, order_model.cancel_reason, order_model.total_weight_kg, order_model.total_amount,
+            item_model.product_id,
+            func.coalesce(ProductVersion.name, item_model.stored_name),
+            item_model.quantity,
+            func.coalesce(ProductVersion.price_per_kg, item_model.stored_price_per_kg),
+            item_model.weight_kg, item_model.amount,
+            item_model.id.label('item_id')
+        ).outerjoin(
+            item_model, item_model.order_id == order_model.id
+        ).outerjoin(
+            ProductVersion, ProductVersion.id == item_model.version_id
+        ).where(
+            order_model.created_at >= date_from,
+            order_model.created_at < date_to
+        ))
+
+    session = ReadSession()
+    try:
+        rows = session.execute(
+            union_all(*parts).order_by('order_id', 'item_id').execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+
+        count = 0
+        for row in rows:
+            # Последняя колонка (id позиции) нужна только для сортировки
+            writer.writerow([format_csv_value(value) for value in row[:-1]])
+            count += 1
+    finally:
+        session.close()
+
+    return count
+
+def build_orders_export(date_from, date_to):
+    """Собирает выгрузку во временный файл на диске и возвращает (файл, кол-во строк)"""
+    buffer = tempfile.TemporaryFile()
+    text_stream = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    try:
+        count = write_orders_csv(text_stream, date_from, date_to)
+        text_stream.flush()
+    except Exception:
+        text_stream.close()
+        raise
+    text_stream.detach()
+    buffer.seek(0)
+    return buffer, count
+
+async def send_orders_export(message, date_from, date_to):
+    """Формирует CSV за период [date_from, date_to) и отправляет его документом"""
+    buffer, count = await asyncio.to_thread(build_orders_export, date_from, date_to)
+    last_day = date_to - timedelta(days=1)
+    filename = f"orders_{date_from.strftime('%Y%m%d')}_{last_day.strftime('%Y%m%d')}.csv"
+    try:
+        await message.reply_document(
+            document=buffer,
+            filename=filename,
+            caption=f"📤 Заказы с {date_from.strftime('%d.%m.%Y')} по {last_day.strftime('%d.%m.%Y')}\nСтрок: {count}"
+        )
+    finally:
+        buffer.close()
+
+async def admin_export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export ДД.ММ.ГГГГ ДД.ММ.ГГГГ — выгрузка заказов за период (обе даты включительно)"""
+    if not is_admin(update.effective_user.id):
+        return
+
+    try:
+        date_from = datetime.strptime(context.args[0], '%d.%m.%Y')
+        date_to = datetime.strptime(context.args[1], '%d.%m.%Y') + timedelta(days=1)
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "Использование: /export ДД.ММ.ГГГГ ДД.ММ.ГГГГ\n"
+            "Например: /export 01.05.2025 31.05.2025"
+        )
+        return
+
+    if date_to <= date_from:
+        await update.message.reply_text("Дата окончания должна быть не раньше даты начала.")
+        return
+
+    await update.message.reply_text("⏳ Формирую выгрузку...")
+    try:
+        await send_orders_export(update.message, date_from, date_to)
+    except Exception as e:
+        logger.error("Ошибка при выгрузке заказов: %s", e)
+        await update.message.reply_text("❌ Не удалось сформировать выгрузку.")
+
+async def admin_export_month(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка админ-панели: выгрузка заказов с начала текущего месяца"""
+    query = update.callback_query
+    await query.answer()
+
+    if not is_admin(query.from_user.id):
+        return
+
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    date_from = today.replace(day=1)
+    date_to = today + timedelta(days=1)
 
-    await update.message.reply_text("Операция отменена.", reply_markup=get_admin_keyboard() if update.effective_user.id == ADMIN_ID else get_main_keyboard(update.effective_user.id))
+    try:
+        await send_orders_export(query.message, date_from, date_to)
+    except Exception as e:
+        logger.error("Ошибка при выгрузке заказов: %s", e)
+        await query.message.reply_text("❌ Не удалось сформировать выгрузку.")
+
+# ========== СТАТИСТИКА ПРОДАЖ ==========
+
+def build_stats_text(days=STATS_DAYS):
+    """Формирует сводку за последние days дней, читая только дневные агрегаты"""
+    since = datetime.now().date() - timedelta(days=days - 1)
+
+    session = ReadSession()
+    daily = session.query(DailyOrderStats).filter(DailyOrderStats.day >= since).order_by(DailyOrderStats.day.desc()).all()
+    top_products = session.query(
+        DailyProductStats.product_name,
+        func.sum(DailyProductStats.ordered_qty),
+        func.sum(DailyProductStats.delivered_qty),
+        func.sum(DailyProductStats.revenue)
+    ).filter(
+        DailyProductStats.day >= since
+    ).group_by(
+        DailyProductStats.product_id, DailyProductStats.product_name
+    ).order_by(
+        func.sum(DailyProductStats.ordered_qty).desc()
+    ).limit(10).all()
+    # Загрузка считается по дню доставки, поэтому сюда попадают и предзаказы на ближайшие дни
+    slots = session.query(
+        func.max(DailySlotStats.delivery_slot),
+        func.sum(DailySlotStats.orders_count)
+    ).filter(
+        DailySlotStats.day >= since
+    ).group_by(
+        DailySlotStats.slot_id
+    ).order_by(
+        DailySlotStats.slot_id
+    ).all()
+    session.close()
+
+    text = f"📊 *СТАТИСТИКА ЗА {days} ДН.*\n\n"
+
+    if not daily:
+        return text + "Заказов за период нет."
+
+    total_created = sum(d.orders_created for d in daily)
+    total_delivered = sum(d.orders_delivered for d in daily)
+    total_cancelled = sum(d.orders_cancelled for d in daily)
+    total_revenue = sum(d.revenue or 0 for d in daily)
+    cancel_rate = total_cancelled / total_created * 100 if total_created else 0
+
+    text += f"🆕 Создано: {total_created}\n"
+    text += f"🎉 Доставлено: {total_delivered}\n"
+    text += f"❌ Отменено: {total_cancelled} ({cancel_rate:.1f}%)\n"
+    text += f"💰 Выручка: {total_revenue:.2f} р\n\n"
+
+    text += "*По дням* (создано / доставлено / отменено, выручка):\n"
+    for d in daily:
+        text += f"  {d.day.strftime('%d.%m')}: {d.orders_created} / {d.orders_delivered} / {d.orders_cancelled}, {d.revenue or 0:.0f} р\n"
+
+    if top_products:
+        text += "\n*Товары* (заказано / доставлено, шт., выручка):\n"
+        for name, ordered, delivered, revenue in top_products:
+            text += f"  • {name}: {ordered or 0} / {delivered or 0}, {revenue or 0:.0f} р\n"
+
+    if slots:
+        text += "\n*Загрузка слотов* (заказов):\n"
+        for slot, count in slots:
+            text += f"  🕐 {slot}: {count}\n"
+
+    return text
+
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    await update.message.reply_text(build_stats_text(), parse_mode='Markdown')
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    if not is_admin(query.from_user.id):
+        return
+
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data=CB_BACK_ADMIN)]]
+    await query.edit_message_text(build_stats_text(), parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    unlock_user_products(user_id)
+
+    await update.message.reply_text("Операция отменена.", reply_markup=get_panel_keyboard(user_id) if is_staff(user_id) else get_main_keyboard(user_id))
     return ConversationHandler.END
 
 # ========== ГЛАВНАЯ ФУНКЦИЯ ==========
 
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def warm_up_caches():
+    """Параллельно заполняет кэши витрины, слотов и ролей, чтобы первые запросы не ждали БД"""
+    started = time.time()
+    results = await asyncio.gather(
+        asyncio.to_thread(get_catalog),
+        asyncio.to_thread(get_slot_availability),
+        asyncio.to_thread(load_permissions),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Ошибка при прогреве кэшей: %s", result)
+    logger.info("Кэши прогреты за %.2f с", time.time() - started)
+
+def start_service_task(coro):
+    """Бесконечный фоновый цикл; при остановке бота отменяется, а не дожидается"""
+    task = start_background_task(coro)
+    service_tasks.add(task)
+    task.add_done_callback(service_tasks.discard)
+    return task
+
+async def post_init(application: Application):
+    start_background_task(warm_up_caches())
+    start_service_task(run_outbox_dispatcher(application))
+    start_service_task(run_cart_flusher())
+    start_service_task(run_reservation_expiry(application))
+    if ORDER_ARCHIVE_DAYS > 0:
+        start_service_task(run_order_archiver())
+
+async def post_stop(application: Application):
+    """Корректная остановка.
+
+    К этому моменту run_polling уже прекратил прием обновлений и дождался
+    обработчиков. Досылаем начатые отправки и очередь уведомлений (не дольше
+    SHUTDOWN_TIMEOUT), сохраняем корзины и снимаем резервы.
+    """
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+    for task in list(service_tasks):
+        task.cancel()
+    await asyncio.gather(*service_tasks, return_exceptions=True)
+
+    pending = [task for task in background_tasks if not task.done()]
+    if pending:
+        _, not_done = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()))
+        for task in not_done:
+            task.cancel()
+        if not_done:
+            logger.warning("При остановке прервано фоновых задач: %s", len(not_done))
+
+    try:
+        while time.monotonic() < deadline:
+            remaining = deadline - time.monotonic()
+            if not await asyncio.wait_for(dispatch_outbox_batch(application.bot), timeout=remaining):
+                break
+    except Exception as e:
+        logger.error("Очередь уведомлений не разобрана до остановки: %r", e)
+
+    try:
+        saved = await asyncio.to_thread(cart_store.flush)
+        logger.info("При остановке сохранено корзин: %s", saved)
+    except Exception as e:
+        logger.error("Ошибка при сохранении корзин: %s", e)
+
+    # Резервы живут только в памяти; корзины сохранены, а остаток перепроверяется при оформлении
+    released = release_all_reservations()
+    logger.info("При остановке снято резервов: %s", released)
+
 def main():
-    init_db()
+    setup_logging()
+
+    # При раскатке через миграции создание таблиц можно пропустить: --skip-init или SKIP_INIT_DB=1
+    if "--skip-init" in sys.argv or os.environ.get("SKIP_INIT_DB") == "1":
+        logger.info("Инициализация БД пропущена")
+    else:
+        init_db()
 
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(post_init).post_stop(post_stop).build()
+
+    # Предварительные проверки до всех обработчиков: сначала флуд, затем доступность БД
+    application.add_handler(TypeHandler(Update, flood_guard), group=-2)
+    application.add_handler(TypeHandler(Update, db_guard), group=-1)
+    application.add_error_handler(handle_error)
 
     # ConversationHandler для добавления товара
     add_product_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_add_product_start, pattern="^admin_add$")],
+        entry_points=[CallbackRouter({
+            CB_ADMIN_ADD: admin_add_product_start,
+            # Выбор черновика и «Новый товар» продолжают диалог добавления
+            CB_DRAFT: select_product_draft,
+            CB_NEW_PRODUCT: new_product
+        })],
         states={
             ADD_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_get_name)],
-            ADD_CATEGORY: [CallbackQueryHandler(admin_get_category, pattern="^newcat_")],
+            ADD_CATEGORY: [CallbackRouter({CB_NEW_CATEGORY: admin_get_category})],
             ADD_QUANTITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_get_quantity)],
             ADD_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_get_price)],
             ADD_PHOTO: [MessageHandler(filters.PHOTO | filters.TEXT, admin_get_photo)]
@@ -1243,13 +3433,18 @@ def main():
         fallbacks=[CommandHandler("cancel", cancel)]
     )
 
-    # Обработчики для выбора черновиков
-    application.add_handler(CallbackQueryHandler(select_product_draft, pattern="^draft_"))
-    application.add_handler(CallbackQueryHandler(new_product, pattern="^new_product$"))
+    # ConversationHandler для отметки доставки с вводом фактического веса
+    admin_delivery_handler = ConversationHandler(
+        entry_points=[CallbackRouter({CB_DELIVERED: admin_mark_delivered})],
+        states={
+            ADMIN_DELIVERY_WEIGHTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_finish_delivery)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)]
+    )
 
     # ConversationHandler для отмены заказа администратором
     admin_cancel_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_start_cancel_order, pattern="^admin_cancel_\\d+$")],
+        entry_points=[CallbackRouter({CB_CANCEL: admin_start_cancel_order})],
         states={
             ADMIN_CANCEL_REASON: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_finish_cancel_order)]
         },
@@ -1258,11 +3453,15 @@ def main():
 
     # ConversationHandler для оформления заказа
     checkout_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(checkout_start, pattern="^checkout$")],
+        entry_points=[CallbackRouter({CB_CHECKOUT: checkout_start})],
         states={
             ORDER_ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_address)],
             ORDER_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_phone)],
-            ORDER_SLOT: [CallbackQueryHandler(select_slot, pattern="^slot_")]
+            ORDER_SLOT: [CallbackRouter({
+                CB_DAY: select_delivery_day,
+                CB_DAY_LIST: select_delivery_day,
+                CB_SLOT: select_slot
+            })]
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
@@ -1270,34 +3469,51 @@ def main():
     # Основные команды
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin_panel_command))
+    application.add_handler(CommandHandler("export", admin_export_command))
+    application.add_handler(CommandHandler("stats", admin_stats_command))
+    application.add_handler(CommandHandler("capacity", admin_slot_capacity))
+    application.add_handler(CommandHandler("threshold", admin_stock_threshold))
+    application.add_handler(CommandHandler("staff", admin_staff_command))
+    application.add_handler(CommandHandler("board", admin_board_command))
+    application.add_handler(CommandHandler("health", admin_health_command))
 
     # ConversationHandlers
     application.add_handler(add_product_handler)
     application.add_handler(admin_cancel_handler)
+    application.add_handler(admin_delivery_handler)
     application.add_handler(checkout_handler)
 
-    # CallbackQueryHandlers для пользователя
-    application.add_handler(CallbackQueryHandler(show_prices, pattern="^prices$"))
-    application.add_handler(CallbackQueryHandler(show_categories, pattern="^order$"))
-    application.add_handler(CallbackQueryHandler(show_category_products, pattern="^cat_"))
-    application.add_handler(CallbackQueryHandler(show_product, pattern="^prod_"))
-    application.add_handler(CallbackQueryHandler(handle_quantity, pattern="^qty_"))
-    application.add_handler(CallbackQueryHandler(add_to_cart, pattern="^add_to_cart$"))
-    application.add_handler(CallbackQueryHandler(clear_cart, pattern="^clear_cart$"))
-    application.add_handler(CallbackQueryHandler(show_my_orders, pattern="^my_order$"))
-    application.add_handler(CallbackQueryHandler(back_to_main, pattern="^back_main$"))
-
-    # CallbackQueryHandlers для администратора
-    application.add_handler(CallbackQueryHandler(show_admin_panel, pattern="^admin_panel$"))
-    application.add_handler(CallbackQueryHandler(back_to_admin, pattern="^back_admin$"))
-    application.add_handler(CallbackQueryHandler(admin_orders, pattern="^admin_orders$"))
-    application.add_handler(CallbackQueryHandler(admin_slots, pattern="^admin_slots$"))
-    application.add_handler(CallbackQueryHandler(toggle_slot, pattern="^toggleslot_"))
-    application.add_handler(CallbackQueryHandler(admin_accept_order, pattern="^admin_accept_\\d+$"))
-    application.add_handler(CallbackQueryHandler(admin_on_the_way, pattern="^admin_on_the_way_\\d+$"))
-    application.add_handler(CallbackQueryHandler(admin_mark_delivered, pattern="^admin_delivered_\\d+$"))
-    application.add_handler(CallbackQueryHandler(admin_cancelled_orders, pattern="^admin_cancelled$"))
-    application.add_handler(CallbackQueryHandler(admin_delivered_list, pattern="^admin_delivered_list$"))
+    # Все остальные кнопки: один обработчик с поиском по опкоду
+    application.add_handler(CallbackRouter({
+        # Пользователь
+        CB_PRICES: show_prices,
+        CB_CATALOG: show_categories,
+        CB_CATEGORY: show_category_products,
+        CB_PRODUCT: show_product,
+        CB_QTY: handle_quantity,
+        CB_ADD_TO_CART: add_to_cart,
+        CB_CLEAR_CART: clear_cart,
+        CB_MY_ORDERS: show_my_orders,
+        CB_REPEAT_ORDER: repeat_order,
+        CB_BACK_MAIN: back_to_main,
+        # Администратор
+        CB_ADMIN_PANEL: show_admin_panel,
+        CB_BACK_ADMIN: back_to_admin,
+        CB_ADMIN_ORDERS: admin_orders,
+        CB_ADMIN_SLOTS: admin_slots,
+        CB_TOGGLE_SLOT: toggle_slot,
+        CB_ACCEPT: admin_accept_order,
+        CB_ON_THE_WAY: admin_on_the_way,
+        CB_CANCELLED_LIST: admin_cancelled_orders,
+        CB_DELIVERED_LIST: admin_delivered_list,
+        CB_ADMIN_EXPORT: admin_export_month,
+        CB_ADMIN_STATS: admin_stats
+    }))
+    # Последним: устаревшие кнопки в старых сообщениях, иначе они остаются с часиками
+    application.add_handler(CallbackQueryHandler(stale_button))
+
+    for handlers in application.handlers.values():
+        bind_log_context(handlers)
 
     print("✅ Бот запущен!")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -1,12 +1,136 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, Index
+import json
+import time
+import atexit
+import itertools
+import tempfile
+import threading
+from sqlalchemy import create_engine, event, inspect, text, func, select, false, Column, Integer, BigInteger, String, Float, Boolean, Date, DateTime, ForeignKey, Text, Index, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, Session as OrmSession
 from datetime import datetime
 
-DATABASE_URL = os.environ.get("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+# Профиль SQLite для локального запуска и замеров: путь к файлу или ":memory:", используется без DATABASE_URL
+SQLITE_PATH = os.environ.get("SQLITE_PATH")
+DATABASE_URL = os.environ.get("DATABASE_URL") or (f"sqlite:///{SQLITE_PATH}" if SQLITE_PATH else None)
+# Необязательная реплика только для чтения: просмотр каталога, история заказов, списки и отчеты
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL")
+# Сколько секунд после записи читать данные с основной БД, пока реплика догоняет
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", "10"))
+# Сколько заказов по умолчанию принимается в один слот доставки за день
+DEFAULT_SLOT_CAPACITY = int(os.environ.get("SLOT_CAPACITY", "5"))
+# При остатке не выше порога товар скрывается из каталога, а администраторы получают уведомление
+DEFAULT_LOW_STOCK_THRESHOLD = int(os.environ.get("LOW_STOCK_THRESHOLD", "0"))
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Создает engine при первом обращении, чтобы импорт models не загружал драйвер БД"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = make_engine(DATABASE_URL)
+    return _engine
+
+def _remove_sqlite_files(path):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+def make_engine(url):
+    if not url.startswith("sqlite"):
+        # pre_ping отбрасывает разорванные соединения пула до выполнения запроса
+        return create_engine(url, pool_pre_ping=True)
+
+    # Соединения пула берут разные потоки (asyncio.to_thread)
+    options = {'connect_args': {'check_same_thread': False}}
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # «БД в памяти» — временный файл в tmpfs (/dev/shm), удаляемый при выходе. Общий кэш
+        # настоящей БД в памяти блокирует таблицы целиком, и чтение либо падает на чужой записи,
+        # либо (read_uncommitted) видит незакоммиченные данные; файл в WAL ведет себя как основной профиль
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="bot-", suffix=".sqlite3", dir=directory)
+        os.close(fd)
+        atexit.register(_remove_sqlite_files, path)
+        url = f"sqlite:///{path}"
+    engine = create_engine(url, **options)
+
+    @event.listens_for(engine, "connect")
+    def configure_sqlite(dbapi_connection, connection_record):
+        # Транзакциями управляет SQLAlchemy, иначе pysqlite ломает SAVEPOINT (begin_nested)
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        # WAL: чтение не блокируется записью
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def begin_sqlite(conn):
+        # Отложенная транзакция: обработчики держат сессии между await, и BEGIN IMMEDIATE
+        # заблокировал бы запись в остальных. Если после чтения в транзакции другое соединение
+        # успело закоммитить запись, следующая запись получает «database is locked» — поэтому
+        # долгие циклы (диспетчер outbox) пишут отдельными короткими транзакциями через run_db
+        conn.exec_driver_sql("BEGIN")
+
+    return engine
+
+class LazySession(OrmSession):
+    def __init__(self, **kwargs):
+        if kwargs.get('bind') is None:
+            kwargs['bind'] = get_engine()
+        super().__init__(**kwargs)
+
+Session = sessionmaker(class_=LazySession)
+
+_replica_engine = None
+
+def get_replica_engine():
+    """Engine реплики; без DATABASE_REPLICA_URL — основной engine"""
+    global _replica_engine
+    if not DATABASE_REPLICA_URL:
+        return get_engine()
+    if _replica_engine is None:
+        with _engine_lock:
+            if _replica_engine is None:
+                _replica_engine = make_engine(DATABASE_REPLICA_URL)
+    return _replica_engine
+
+_ReplicaSession = sessionmaker(class_=LazySession)
+# Ключ (id пользователя или имя раздела) -> время последней записи
+_recent_writes = {}
+_recent_writes_lock = threading.Lock()
+
+def mark_written(key):
+    """Запоминает запись, после которой чтение по ключу временно идет с основной БД"""
+    now = time.monotonic()
+    with _recent_writes_lock:
+        _recent_writes[key] = now
+        if len(_recent_writes) > 10000:
+            for stale in [k for k, at in _recent_writes.items() if now - at > REPLICA_MAX_LAG]:
+                del _recent_writes[stale]
+
+def ReadSession(key=None):
+    """Сессия для экранов только на чтение.
+
+    Идет на реплику, кроме случая, когда по ключу недавно была запись:
+    тогда реплика может еще не содержать ее, и читаем с основной БД.
+    """
+    if not DATABASE_REPLICA_URL:
+        return Session()
+    if key is not None:
+        with _recent_writes_lock:
+            written_at = _recent_writes.get(key)
+        if written_at is not None and time.monotonic() - written_at < REPLICA_MAX_LAG:
+            return Session()
+    return _ReplicaSession(bind=get_replica_engine())
 Base = declarative_base()
 
 class Product(Base):
@@ -18,9 +142,56 @@ class Product(Base):
     price_per_kg = Column(Float, nullable=False)
     quantity = Column(Integer, default=0)
     is_available = Column(Boolean, default=True)
+    low_stock_threshold = Column(Integer, nullable=False, default=DEFAULT_LOW_STOCK_THRESHOLD, server_default='0')
     photo_id = Column(String(255), nullable=True)
+    # Текущая версия из product_versions (без внешнего ключа, чтобы таблицы не ссылались друг на друга)
+    version_id = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class ProductVersion(Base):
+    """Неизменяемый снимок названия и цены товара; позиции корзин и заказов ссылаются на него по id"""
+    __tablename__ = 'product_versions'
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('products.id'), index=True, nullable=False)
+    name = Column(String(255), nullable=False)
+    price_per_kg = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+def ensure_product_version(session, product):
+    """Создает новую версию, если название или цена товара изменились; возвращает id текущей версии"""
+    if product.id is None:
+        session.flush()
+    current = session.get(ProductVersion, product.version_id) if product.version_id else None
+    if current and current.name == product.name and current.price_per_kg == product.price_per_kg:
+        return current.id
+    version = ProductVersion(product_id=product.id, name=product.name, price_per_kg=product.price_per_kg)
+    session.add(version)
+    session.flush()
+    product.version_id = version.id
+    return version.id
+
+class ProductLine:
+    """Позиция со ссылкой на версию товара.
+
+    Новые строки хранят только version_id; у старых название и цена лежат
+    в колонках product_name и price_per_kg — они показываются, если версии нет.
+    """
+
+    @property
+    def product_name(self):
+        return self.version.name if self.version else self.stored_name
+
+    @property
+    def price_per_kg(self):
+        return self.version.price_per_kg if self.version else self.stored_price_per_kg
+
+def line_price_fields(version_id, product_name, price_per_kg):
+    """Поля позиции: ссылка на версию, а без нее — копия названия и цены"""
+    if version_id:
+        return {'version_id': version_id}
+    return {'stored_name': product_name, 'stored_price_per_kg': price_per_kg}
+
 class DeliverySlot(Base):
     __tablename__ = 'delivery_slots'
 
@@ -28,14 +199,39 @@ class DeliverySlot(Base):
     start_hour = Column(Integer, nullable=False)
     end_hour = Column(Integer, nullable=False)
     is_active = Column(Boolean, default=True)
+    capacity = Column(Integer, nullable=False, default=DEFAULT_SLOT_CAPACITY, server_default=str(DEFAULT_SLOT_CAPACITY))
+
+class SlotInstance(Base):
+    """Слот доставки на конкретную дату: вместимость и счетчик занятых мест"""
+    __tablename__ = 'slot_instances'
+    __table_args__ = (
+        UniqueConstraint('slot_id', 'day', name='uq_slot_instances_slot_day'),
+        Index('ix_slot_instances_day', 'day'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    slot_id = Column(Integer, ForeignKey('delivery_slots.id'), nullable=False)
+    day = Column(Date, nullable=False)
+    capacity = Column(Integer, nullable=False)
+    booked = Column(Integer, nullable=False, default=0, server_default='0')
+
+    slot = relationship("DeliverySlot")
 
 class Order(Base):
     __tablename__ = 'orders'
+    __table_args__ = (
+        Index('uq_orders_checkout_key', 'checkout_key', unique=True),
+        # История заказов пользователя листается по id (keyset-пагинация)
+        Index('ix_orders_user_id_id', 'user_id', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
     user_name = Column(String)
     delivery_slot = Column(String)
+    slot_id = Column(Integer, ForeignKey('delivery_slots.id'), nullable=True, index=True)
+    slot_instance_id = Column(Integer, ForeignKey('slot_instances.id'), nullable=True, index=True)
+    delivery_date = Column(Date, nullable=True, index=True)
     address = Column(String)
     phone = Column(String)
     status = Column(String, default='pending')  # pending, active, on_the_way, delivered, cancelled
@@ -44,34 +240,520 @@ class Order(Base):
     cancelled_at = Column(DateTime, nullable=True)
     delivered_at = Column(DateTime, nullable=True)
     on_the_way_at = Column(DateTime, nullable=True)  # Когда курьер отправился
+    # Итог по фактическому весу, вводится курьером при доставке
+    total_weight_kg = Column(Float, nullable=True)
+    total_amount = Column(Float, nullable=True)
+    checkout_key = Column(String(64), nullable=True)  # Ключ идемпотентности оформления
+    claimed_by = Column(BigInteger, nullable=True)  # Диспетчер, принявший заказ
+    claimed_by_name = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    # Товар списан со склада при оформлении; у заказов, оформленных до этого, остатки не менялись
+    stock_written_off = Column(Boolean, nullable=False, default=False, server_default=false())
 
-    items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
+    items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan", order_by="OrderItem.id")
 
-class OrderItem(Base):
+class OrderItem(ProductLine, Base):
     __tablename__ = 'order_items'
 
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'))
+    order_id = Column(Integer, ForeignKey('orders.id'), index=True)
     product_id = Column(Integer, ForeignKey('products.id'))
-    product_name = Column(String(255))
+    version_id = Column(Integer, ForeignKey('product_versions.id'), nullable=True)
+    stored_name = Column('product_name', String(255), nullable=True)
     quantity = Column(Integer)
-    price_per_kg = Column(Float)
+    stored_price_per_kg = Column('price_per_kg', Float, nullable=True)
+    weight_kg = Column(Float, nullable=True)  # Фактический вес при доставке
+    amount = Column(Float, nullable=True)
     order = relationship("Order", back_populates="items")
+    version = relationship("ProductVersion", lazy='joined')
 
-class Cart(Base):
+class Cart(ProductLine, Base):
     __tablename__ = 'carts'
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     product_id = Column(Integer, ForeignKey('products.id'))
-    product_name = Column(String(255))
+    version_id = Column(Integer, ForeignKey('product_versions.id'), nullable=True)
+    stored_name = Column('product_name', String(255), nullable=True)
     quantity = Column(Integer, default=1)
-    price_per_kg = Column(Float)
+    stored_price_per_kg = Column('price_per_kg', Float, nullable=True)
+    version = relationship("ProductVersion", lazy='joined')
+
+class StaffMember(Base):
+    """Сотрудник с доступом к панели: admin — полный доступ, courier — только заказы"""
+    __tablename__ = 'staff'
+
+    user_id = Column(BigInteger, primary_key=True)
+    role = Column(String(20), nullable=False)
+    name = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+class OrderEvent(Base):
+    """Журнал переходов статуса заказа и очередь исходящих уведомлений (outbox).
+
+    Событие пишется в той же транзакции, что и изменение заказа, а уведомления
+    отправляет фоновый диспетчер, поэтому падение между commit и отправкой
+    не теряет сообщение (доставка «хотя бы один раз»).
+    """
+    __tablename__ = 'order_events'
+    __table_args__ = (
+        Index('ix_order_events_pending', 'processed_at', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False, index=True)
+    event_type = Column(String(30), nullable=False)  # created, accepted, on_the_way, delivered, cancelled
+    payload = Column(Text, nullable=True)  # JSON
+    created_at = Column(DateTime, default=datetime.now)
+    processed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=True)  # Раньше этого времени повтор не отправляется
+
+    @property
+    def data(self):
+        return json.loads(self.payload) if self.payload else {}
+
+def add_order_event(session, order_id, event_type, **payload):
+    """Добавляет событие заказа в outbox в текущей транзакции"""
+    event = OrderEvent(order_id=order_id, event_type=event_type, payload=json.dumps(payload, ensure_ascii=False) if payload else None)
+    session.add(event)
+    return event
+
+class AdminBoard(Base):
+    """Закрепленное сообщение-доска с активными заказами у сотрудника"""
+    __tablename__ = 'admin_boards'
+
+    user_id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+def claim_order(session, order_id, user_id, user_name):
+    """Атомарно закрепляет ожидающий заказ за диспетчером и подтверждает его.
+
+    Из нескольких диспетчеров, нажавших «Подтвердить» одновременно,
+    UPDATE пройдет только у одного. Возвращает True, если заказ закреплен.
+    """
+    updated = session.query(Order).filter(
+        Order.id == order_id,
+        Order.status == 'pending'
+    ).update({
+        Order.status: 'active',
+        Order.claimed_by: user_id,
+        Order.claimed_by_name: user_name,
+        Order.claimed_at: datetime.now()
+    }, synchronize_session=False)
+    return updated == 1
+
+def apply_stock_threshold(product):
+    """Скрывает товар при остатке не выше порога и возвращает в каталог, когда остаток снова выше.
+
+    Возвращает 'low', 'restocked' или None, если доступность не изменилась.
+    """
+    available = product.quantity > product.low_stock_threshold
+    if product.is_available == available:
+        return None
+    product.is_available = available
+    return 'restocked' if available else 'low'
+
+class OutOfStock(Exception):
+    """Списание увело бы остаток товаров product_ids ниже нуля"""
+
+    def __init__(self, product_ids):
+        super().__init__(product_ids)
+        self.product_ids = product_ids
+
+def change_stock(session, quantities):
+    """Атомарно меняет остатки {product_id: delta} и проверяет пороги только у затронутых товаров.
+
+    Списание проходит, только если остатка хватает, иначе OutOfStock —
+    вызывающий откатывает транзакцию. Возвращает список
+    (название, остаток, порог, 'low' | 'restocked') для товаров, чья доступность
+    изменилась, — его можно использовать и после закрытия сессии.
+    """
+    short = []
+    for product_id, delta in quantities.items():
+        if not delta:
+            continue
+        stock_query = session.query(Product).filter(Product.id == product_id)
+        if delta < 0:
+            stock_query = stock_query.filter(Product.quantity >= -delta)
+        if not stock_query.update({Product.quantity: Product.quantity + delta}, synchronize_session=False) and delta < 0:
+            short.append(product_id)
+    if short:
+        raise OutOfStock(short)
+    changed = []
+    products = session.query(Product).filter(Product.id.in_(list(quantities))).populate_existing()
+    for product in products:
+        change = apply_stock_threshold(product)
+        if change:
+            changed.append((product.name, product.quantity, product.low_stock_threshold, change))
+    return changed
+
+def set_order_status(session, order_id, expected, status, **values):
+    """Атомарно переводит заказ в status, только если его текущий статус из expected.
+
+    Устаревшая кнопка у другого диспетчера не сможет повторить или откатить
+    переход. Возвращает True, если статус изменен.
+    """
+    updated = session.query(Order).filter(
+        Order.id == order_id,
+        Order.status.in_(expected)
+    ).update({
+        Order.status: status,
+        **{getattr(Order, name): value for name, value in values.items()}
+    }, synchronize_session=False)
+    return updated == 1
+
+def get_slot_instance(session, slot_id, day):
+    """Возвращает слот на дату day, создавая его с вместимостью шаблона при первом обращении"""
+    instance = session.query(SlotInstance).filter(SlotInstance.slot_id == slot_id, SlotInstance.day == day).first()
+    if instance:
+        return instance
+
+    slot = session.query(DeliverySlot).filter(DeliverySlot.id == slot_id).first()
+    if not slot:
+        return None
+
+    try:
+        with session.begin_nested():
+            instance = SlotInstance(slot_id=slot_id, day=day, capacity=slot.capacity, booked=0)
+            session.add(instance)
+    except IntegrityError:
+        # Слот на эту дату параллельно создал другой обработчик
+        instance = session.query(SlotInstance).filter(SlotInstance.slot_id == slot_id, SlotInstance.day == day).first()
+    return instance
+
+def book_slot(session, slot_id, day):
+    """Атомарно занимает место в слоте на дату day.
+
+    Проверка вместимости и инкремент выполняются одним UPDATE, поэтому
+    параллельные оформления не могут переполнить слот.
+    Возвращает SlotInstance или None, если мест нет.
+    """
+    instance = get_slot_instance(session, slot_id, day)
+    if not instance or not instance.slot.is_active:
+        return None
+
+    updated = session.query(SlotInstance).filter(
+        SlotInstance.id == instance.id,
+        SlotInstance.booked < SlotInstance.capacity
+    ).update({SlotInstance.booked: SlotInstance.booked + 1}, synchronize_session=False)
+    return instance if updated == 1 else None
+
+def release_slot(session, slot_instance_id):
+    """Возвращает место в слот (например, при отмене заказа)"""
+    session.query(SlotInstance).filter(
+        SlotInstance.id == slot_instance_id,
+        SlotInstance.booked > 0
+    ).update({SlotInstance.booked: SlotInstance.booked - 1}, synchronize_session=False)
+
+# ========== ДНЕВНЫЕ АГРЕГАТЫ ДЛЯ АНАЛИТИКИ ==========
+# Заполняются инкрементально при каждой смене статуса заказа (record_order_stats),
+# поэтому экран статистики читает O(дней) строк, а не всю таблицу orders.
+
+class DailyOrderStats(Base):
+    __tablename__ = 'daily_order_stats'
+
+    day = Column(Date, primary_key=True)
+    orders_created = Column(Integer, nullable=False, default=0)
+    orders_delivered = Column(Integer, nullable=False, default=0)
+    orders_cancelled = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0, server_default='0')
+
+class DailyProductStats(Base):
+    __tablename__ = 'daily_product_stats'
+
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    product_name = Column(String(255))
+    ordered_qty = Column(Integer, nullable=False, default=0)
+    delivered_qty = Column(Integer, nullable=False, default=0)
+    cancelled_qty = Column(Integer, nullable=False, default=0)
+    delivered_weight_kg = Column(Float, nullable=False, default=0, server_default='0')
+    revenue = Column(Float, nullable=False, default=0, server_default='0')
+
+class DailySlotStats(Base):
+    """Загрузка слотов: заказы по дню доставки и слоту (а не по дню оформления)"""
+    __tablename__ = 'daily_slot_load'
+
+    day = Column(Date, primary_key=True)  # День доставки
+    slot_id = Column(Integer, primary_key=True)  # 0 — заказы без слота
+    delivery_slot = Column(String(50), nullable=False, default='')
+    orders_count = Column(Integer, nullable=False, default=0)
+
+def _bump_stats(session, model, key, increments, **attrs):
+    """Атомарно увеличивает счетчики строки агрегата, создавая ее при необходимости"""
+    values = {getattr(model, name): getattr(model, name) + delta for name, delta in increments.items()}
+    if session.query(model).filter_by(**key).update(values, synchronize_session=False):
+        return
+
+    try:
+        with session.begin_nested():
+            session.add(model(**key, **attrs, **increments))
+    except IntegrityError:
+        # Строку успел создать параллельный обработчик — просто увеличиваем счетчики
+        session.query(model).filter_by(**key).update(values, synchronize_session=False)
+
+def record_order_stats(session, order, status, items, when=None):
+    """Учитывает переход заказа в статус status в дневных агрегатах.
+
+    Вызывается в той же транзакции, что и изменение заказа:
+    'pending' — заказ создан, 'delivered' — доставлен, 'cancelled' — отменен.
+    """
+    day = (when or datetime.now()).date()
+
+    if status == 'pending':
+        _bump_stats(session, DailyOrderStats, {'day': day}, {'orders_created': 1})
+        _bump_stats(
+            session, DailySlotStats,
+            {'day': order.delivery_date or day, 'slot_id': order.slot_id or 0},
+            {'orders_count': 1},
+            delivery_slot=order.delivery_slot or ''
+        )
+        field = 'ordered_qty'
+    elif status == 'delivered':
+        _bump_stats(session, DailyOrderStats, {'day': day}, {'orders_delivered': 1, 'revenue': order.total_amount or 0})
+        field = 'delivered_qty'
+    elif status == 'cancelled':
+        _bump_stats(session, DailyOrderStats, {'day': day}, {'orders_cancelled': 1})
+        field = 'cancelled_qty'
+    else:
+        return
+
+    for item in items:
+        increments = {field: item.quantity}
+        if status == 'delivered':
+            increments.update(delivered_weight_kg=item.weight_kg or 0, revenue=item.amount or 0)
+        _bump_stats(
+            session, DailyProductStats,
+            {'day': day, 'product_id': item.product_id or 0},
+            increments,
+            product_name=item.product_name
+        )
+
+def rebuild_daily_stats(session, batch_size=1000):
+    """Полный пересчет агрегатов по истории заказов, включая архив (однократно, для уже существующих данных)"""
+    session.query(DailyOrderStats).delete()
+    session.query(DailyProductStats).delete()
+    session.query(DailySlotStats).delete()
+
+    orders = {}
+    products = {}
+    slots = {}
+
+    def order_rows(order_model, item_model):
+        return session.query(
+            order_model.id, order_model.created_at, order_model.delivered_at, order_model.cancelled_at, order_model.status,
+            order_model.delivery_date, order_model.slot_id, order_model.delivery_slot, order_model.total_amount,
+            item_model.id, item_model.product_id, func.coalesce(ProductVersion.name, item_model.stored_name), item_model.quantity,
+            item_model.weight_kg, item_model.amount
+        ).outerjoin(item_model, item_model.order_id == order_model.id).outerjoin(
+            ProductVersion, ProductVersion.id == item_model.version_id
+        ).order_by(order_model.id, item_model.id).yield_per(batch_size)
+
+    # Заказ лежит либо в рабочих таблицах, либо в архиве, поэтому история учитывается один раз
+    rows = itertools.chain(order_rows(Order, OrderItem), order_rows(ArchivedOrder, ArchivedOrderItem))
+
+    last_order_id = None
+    for (order_id, created_at, delivered_at, cancelled_at, status, delivery_date, slot_id, slot, total_amount,
+         item_id, product_id, product_name, quantity, weight_kg, amount) in rows:
+        events = [('pending', created_at)]
+        if status == 'delivered' and delivered_at:
+            events.append(('delivered', delivered_at))
+        if status == 'cancelled' and cancelled_at:
+            events.append(('cancelled', cancelled_at))
+
+        # Заказ с несколькими позициями встречается в нескольких строках — считаем его один раз
+        first_row = order_id != last_order_id
+        last_order_id = order_id
+
+        for event, when in events:
+            day = when.date()
+            if first_row:
+                counters = orders.setdefault(day, {'pending': 0, 'delivered': 0, 'cancelled': 0, 'revenue': 0})
+                counters[event] += 1
+                if event == 'pending':
+                    entry = slots.setdefault((delivery_date or day, slot_id or 0), {'label': slot or '', 'count': 0})
+                    entry['count'] += 1
+                if event == 'delivered':
+                    counters['revenue'] += total_amount or 0
+            if item_id is not None:
+                entry = products.setdefault((day, product_id or 0), {
+                    'name': product_name, 'pending': 0, 'delivered': 0, 'cancelled': 0, 'weight': 0, 'revenue': 0
+                })
+                entry[event] += quantity or 0
+                if event == 'delivered':
+                    entry['weight'] += weight_kg or 0
+                    entry['revenue'] += amount or 0
+
+    for day, counters in orders.items():
+        session.add(DailyOrderStats(
+            day=day,
+            orders_created=counters['pending'],
+            orders_delivered=counters['delivered'],
+            orders_cancelled=counters['cancelled'],
+            revenue=counters['revenue']
+        ))
+    for (day, product_id), entry in products.items():
+        session.add(DailyProductStats(
+            day=day,
+            product_id=product_id,
+            product_name=entry['name'],
+            ordered_qty=entry['pending'],
+            delivered_qty=entry['delivered'],
+            cancelled_qty=entry['cancelled'],
+            delivered_weight_kg=entry['weight'],
+            revenue=entry['revenue']
+        ))
+    for (day, slot_id), entry in slots.items():
+        session.add(DailySlotStats(day=day, slot_id=slot_id, delivery_slot=entry['label'], orders_count=entry['count']))
+
+# ========== АРХИВ ЗАКАЗОВ ==========
+# Завершенные давние заказы переносятся из orders/order_items в архивные таблицы
+# с теми же id, чтобы рабочие таблицы оставались маленькими, а история — доступной.
+
+class ArchivedOrder(Base):
+    __tablename__ = 'orders_archive'
+    __table_args__ = (
+        Index('ix_orders_archive_user_id_id', 'user_id', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)  # id заказа из orders
+    user_id = Column(BigInteger)
+    user_name = Column(String)
+    delivery_slot = Column(String)
+    slot_id = Column(Integer, nullable=True)
+    slot_instance_id = Column(Integer, nullable=True)
+    delivery_date = Column(Date, nullable=True)
+    address = Column(String)
+    phone = Column(String)
+    status = Column(String)
+    cancel_reason = Column(Text, nullable=True)
+    created_at = Column(DateTime, index=True)
+    cancelled_at = Column(DateTime, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    on_the_way_at = Column(DateTime, nullable=True)
+    total_weight_kg = Column(Float, nullable=True)
+    total_amount = Column(Float, nullable=True)
+    checkout_key = Column(String(64), nullable=True)
+    claimed_by = Column(BigInteger, nullable=True)
+    claimed_by_name = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, server_default=func.now())
+
+    items = relationship("ArchivedOrderItem", order_by="ArchivedOrderItem.id")
+
+class ArchivedOrderItem(ProductLine, Base):
+    __tablename__ = 'order_items_archive'
+
+    id = Column(Integer, primary_key=True)  # id позиции из order_items
+    order_id = Column(Integer, ForeignKey('orders_archive.id'), index=True)
+    product_id = Column(Integer)
+    version_id = Column(Integer, ForeignKey('product_versions.id'), nullable=True)
+    stored_name = Column('product_name', String(255), nullable=True)
+    quantity = Column(Integer)
+    stored_price_per_kg = Column('price_per_kg', Float, nullable=True)
+    weight_kg = Column(Float, nullable=True)
+    amount = Column(Float, nullable=True)
+    version = relationship("ProductVersion", lazy='joined')
+
+class ArchivedOrderEvent(Base):
+    """События архивных заказов: журнал смены статусов сохраняется целиком"""
+    __tablename__ = 'order_events_archive'
+
+    id = Column(Integer, primary_key=True)  # id события из order_events
+    order_id = Column(Integer, ForeignKey('orders_archive.id'), nullable=False, index=True)
+    event_type = Column(String(30), nullable=False)
+    payload = Column(Text, nullable=True)
+    created_at = Column(DateTime)
+    processed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=True)
+
+def archive_orders(session, before, batch_size=500):
+    """Переносит в архив одну пачку заказов, завершенных раньше before; возвращает их число.
+
+    События заказов переносятся в order_events_archive вместе с ними.
+    Заказы с неотправленными уведомлениями ждут следующего прохода.
+    """
+    finished_at = func.coalesce(Order.delivered_at, Order.cancelled_at, Order.created_at)
+    has_pending_events = session.query(OrderEvent.id).filter(
+        OrderEvent.order_id == Order.id,
+        OrderEvent.processed_at.is_(None)
+    ).exists()
+    ids = [order_id for order_id, in session.query(Order.id).filter(
+        Order.status.in_(['delivered', 'cancelled']),
+        finished_at < before,
+        ~has_pending_events
+    ).order_by(Order.id).limit(batch_size).with_for_update(skip_locked=True)]
+    if not ids:
+        return 0
+
+    order_columns = [column.name for column in ArchivedOrder.__table__.columns if column.name != 'archived_at']
+    item_columns = [column.name for column in ArchivedOrderItem.__table__.columns]
+    event_columns = [column.name for column in ArchivedOrderEvent.__table__.columns]
+    session.execute(ArchivedOrder.__table__.insert().from_select(
+        order_columns,
+        select(*[Order.__table__.c[name] for name in order_columns]).where(Order.id.in_(ids))
+    ))
+    session.execute(ArchivedOrderItem.__table__.insert().from_select(
+        item_columns,
+        select(*[OrderItem.__table__.c[name] for name in item_columns]).where(OrderItem.order_id.in_(ids))
+    ))
+    session.execute(ArchivedOrderEvent.__table__.insert().from_select(
+        event_columns,
+        select(*[OrderEvent.__table__.c[name] for name in event_columns]).where(OrderEvent.order_id.in_(ids))
+    ))
+
+    session.query(OrderEvent).filter(OrderEvent.order_id.in_(ids)).delete(synchronize_session=False)
+    session.query(OrderItem).filter(OrderItem.order_id.in_(ids)).delete(synchronize_session=False)
+    session.query(Order).filter(Order.id.in_(ids)).delete(synchronize_session=False)
+    return len(ids)
+
+def _add_missing_columns():
+    """create_all не изменяет существующие таблицы — досоздаем новые колонки и индексы"""
+    engine = get_engine()
+    with engine.begin() as conn:
+        # Инспектор на том же соединении: у SQLite в памяти оно единственное
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.execute(text(ddl))
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
 
 def init_db():
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine())
+    _add_missing_columns()
     session = Session()
 
+    # Первичное заполнение агрегатов, если таблицы аналитики только что созданы
+    stats_missing = session.query(DailyOrderStats).count() == 0 or session.query(DailySlotStats).count() == 0
+    if stats_missing and (session.query(Order).count() > 0 or session.query(ArchivedOrder).count() > 0):
+        rebuild_daily_stats(session)
+        session.commit()
+
+    # Версии для товаров, созданных до появления product_versions
+    unversioned = session.query(Product).filter(Product.version_id.is_(None)).all()
+    if unversioned:
+        for product in unversioned:
+            ensure_product_version(session, product)
+        session.commit()
+
     # Создание слотов доставки, если их нет
     existing_slots = session.query(DeliverySlot).count()
     if existing_slots == 0: